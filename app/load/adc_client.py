@@ -0,0 +1,322 @@
+#
+# Shared configuration, token and HTTP session for the ADC repository
+# load, setup and conversion scripts. This assumes you are running in
+# the docker container.
+#
+# The token is cached until shortly before it expires, so scripts can
+# call getToken() as often as they like without a round trip to /token.
+# All requests should go through getSession() so connections are kept
+# alive and reused.
+#
+# Large JSON bodies can be sent with postJSON(), which uses a faster JSON
+# encoder if one is installed (orjson or ujson), and can compress the body
+# with gzip or zstd. If the server rejects a compressed body, compression
+# is turned off and the request is sent again uncompressed. With
+# stream_body, the records are encoded and compressed as the request is
+# sent, in chunks, so the whole body is never held in memory.
+#
+# When several loader processes run at once, setRequestLimit() can be given
+# a multiprocessing semaphore to cap the number of requests in flight
+# across all of them. Requests should be made within requestSlot().
+#
+# queryDocuments() fetches the documents matching a query a page at a time.
+#
+# URLs should start with apiURL(config). The scheme is https unless
+# ADC_LOAD_API_SCHEME is set, such as http for a local mock server.
+#
+
+from dotenv import load_dotenv
+import os
+import json
+import gzip
+import zlib
+import threading
+import time
+import contextlib
+import urllib.parse
+import requests
+
+# optional faster encoders and compression
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# refresh the token when it has less than this many seconds left
+token_refresh_margin = 300
+
+# bytes per chunk of a streamed request body
+stream_chunk_size = 65536
+
+_lock = threading.Lock()
+_token_cache = {}
+_session = None
+_compression_rejected = False
+_request_limit = None
+
+json_encoders = [ 'auto', 'orjson', 'ujson', 'json' ]
+compressions = [ 'none', 'gzip', 'zstd' ]
+
+# Setup
+def getConfig():
+    if load_dotenv(dotenv_path='/api-js-tapis/.env'):
+        cfg = {}
+        cfg['api_scheme'] = os.getenv('ADC_LOAD_API_SCHEME', 'https')
+        cfg['api_server'] = os.getenv('WSO2_HOST')
+        cfg['api_key'] = os.getenv('WSO2_CLIENT_KEY')
+        cfg['api_secret'] = os.getenv('WSO2_CLIENT_SECRET')
+        cfg['username'] = os.getenv('VDJ_SERVICE_ACCOUNT')
+        cfg['password'] = os.getenv('VDJ_SERVICE_ACCOUNT_SECRET')
+        cfg['dbname'] = os.getenv('MONGODB_DB')
+        cfg['pool_size'] = int(os.getenv('ADC_LOAD_POOL_SIZE', '10'))
+        cfg['json_encoder'] = os.getenv('ADC_LOAD_JSON_ENCODER', 'auto')
+        cfg['compression'] = os.getenv('ADC_LOAD_COMPRESSION', 'none')
+        cfg['compression_level'] = int(os.getenv('ADC_LOAD_COMPRESSION_LEVEL', '1'))
+        cfg['stream_body'] = os.getenv('ADC_LOAD_STREAM_BODY', 'false') == 'true'
+        return cfg
+    else:
+        print('ERROR: loading config')
+        return None
+
+# Configuration when there is no .env file, for loading into
+# a local sink or a mock server
+def offlineConfig():
+    return {
+        "api_scheme": "http",
+        "api_server": "localhost:8080",
+        "api_key": "offline",
+        "api_secret": "offline",
+        "username": "offline",
+        "password": "offline",
+        "dbname": "offline",
+        "pool_size": int(os.getenv('ADC_LOAD_POOL_SIZE', '10')),
+        "json_encoder": os.getenv('ADC_LOAD_JSON_ENCODER', 'auto'),
+        "compression": os.getenv('ADC_LOAD_COMPRESSION', 'none'),
+        "compression_level": int(os.getenv('ADC_LOAD_COMPRESSION_LEVEL', '1')),
+        "stream_body": os.getenv('ADC_LOAD_STREAM_BODY', 'false') == 'true'
+    }
+
+# Base URL of the API server
+def apiURL(config):
+    return config.get('api_scheme', 'https') + '://' + config['api_server']
+
+# Use another API server, such as mock_restheart.py, given as a base URL
+def setAPIURL(config, api_url):
+    url = urllib.parse.urlparse(api_url)
+    config['api_scheme'] = url.scheme
+    config['api_server'] = url.netloc + url.path.rstrip('/')
+    return config
+
+# Configuration for the scripts that query the repository, the .env
+# file is optional when another API server is given
+def apiConfig(api_url=None):
+    if api_url is None:
+        return getConfig()
+    config = offlineConfig()
+    if os.path.exists('/api-js-tapis/.env'):
+        config = getConfig()
+    return setAPIURL(config, api_url)
+
+# Keep-alive session shared by all requests, the connection pool
+# should be at least as large as the number of concurrent threads
+def getSession(config=None):
+    global _session
+    with _lock:
+        if _session is None:
+            pool_size = 10
+            if config and config.get('pool_size'):
+                pool_size = config['pool_size']
+            _session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+        return _session
+
+# Limit the number of requests in flight with a semaphore,
+# which can be shared between processes
+def setRequestLimit(semaphore):
+    global _request_limit
+    _request_limit = semaphore
+
+@contextlib.contextmanager
+def requestSlot():
+    if _request_limit is None:
+        yield
+    else:
+        with _request_limit:
+            yield
+
+# Fetches a user token based on the supplied auth object
+# and returns the auth object with token data on success.
+# The token is reused until it is close to expiring.
+def getToken(config, force=False):
+    key = (config['api_server'], config['username'])
+    with _lock:
+        entry = _token_cache.get(key)
+        if entry and not force and time.time() < entry['refresh_at']:
+            return entry['token']
+
+    data = {
+        "grant_type":"password",
+        "scope":"PRODUCTION",
+        "username":config['username'],
+        "password":config['password']
+    }
+    headers = {
+        "Content-Type":"application/x-www-form-urlencoded"
+    }
+
+    url = apiURL(config) + '/token'
+
+    resp = getSession(config).post(url, data=data, headers=headers, auth=(config['api_key'], config['api_secret']))
+    token = resp.json()
+
+    # only cache a valid token, errors are returned to the caller as before
+    if token.get('access_token'):
+        expires_in = int(token.get('expires_in', 0))
+        margin = min(token_refresh_margin, expires_in / 2)
+        with _lock:
+            _token_cache[key] = { "token": token, "refresh_at": time.time() + expires_in - margin }
+    return token
+
+# Name of the encoder that will be used, falling back
+# to the standard library if the requested one is missing
+def jsonEncoder(name='auto'):
+    if name in ('auto', 'orjson') and orjson is not None:
+        return 'orjson'
+    if name in ('auto', 'ujson') and ujson is not None:
+        return 'ujson'
+    return 'json'
+
+# Encode an object into JSON bytes
+def encodeJSON(obj, encoder='auto'):
+    encoder = jsonEncoder(encoder)
+    if encoder == 'orjson':
+        return orjson.dumps(obj)
+    if encoder == 'ujson':
+        return ujson.dumps(obj, ensure_ascii=False).encode('utf-8')
+    return json.dumps(obj).encode('utf-8')
+
+# Compress the body, returns the body and its Content-Encoding. zstd
+# falls back to gzip if the zstandard module is not installed.
+def compressBody(body, compression='gzip', level=1):
+    if compression == 'zstd' and zstandard is not None:
+        return zstandard.ZstdCompressor(level=level).compress(body), 'zstd'
+    if compression in ('gzip', 'zstd'):
+        return gzip.compress(body, compresslevel=level), 'gzip'
+    return body, None
+
+# Encode a list of records as a JSON array, one record at a time,
+# yielding chunks of about chunk_size bytes
+def streamJSON(records, encoder='auto', chunk_size=stream_chunk_size):
+    chunk = [ b'[' ]
+    size = 1
+    for i, r in enumerate(records):
+        if i > 0:
+            chunk.append(b',')
+        data = encodeJSON(r, encoder)
+        chunk.append(data)
+        size += len(data) + 1
+        if size >= chunk_size:
+            yield b''.join(chunk)
+            chunk = []
+            size = 0
+    chunk.append(b']')
+    yield b''.join(chunk)
+
+# Compress a stream of chunks, returns the compressed stream and its
+# Content-Encoding, with the same fallback as compressBody()
+def compressStream(chunks, compression='gzip', level=1):
+    if compression == 'zstd' and zstandard is not None:
+        compressor = zstandard.ZstdCompressor(level=level).compressobj()
+        encoding = 'zstd'
+    elif compression in ('gzip', 'zstd'):
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+        encoding = 'gzip'
+    else:
+        return chunks, None
+
+    def generate():
+        for chunk in chunks:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+    return generate(), encoding
+
+# The server does not accept the compressed body, a 415 or a 400 that
+# names the encoding, any other 400 is an error in the documents
+def compressionRejected(resp):
+    if resp.status_code == 415:
+        return True
+    if resp.status_code == 400:
+        text = resp.text.lower()
+        return 'content-encoding' in text or 'content encoding' in text
+    return False
+
+# POST an object as JSON with the configured encoder and compression
+def postJSON(config, url, obj, headers):
+    global _compression_rejected
+    session = getSession(config)
+    encoder = config.get('json_encoder', 'auto')
+    stream = config.get('stream_body', False) and isinstance(obj, list)
+    if stream:
+        body = None
+    else:
+        body = encodeJSON(obj, encoder)
+    headers = dict(headers)
+    headers['Content-Type'] = 'application/json'
+
+    compression = config.get('compression', 'none')
+    if compression != 'none' and not _compression_rejected:
+        if stream:
+            compressed, encoding = compressStream(streamJSON(obj, encoder), compression, config.get('compression_level', 1))
+        else:
+            compressed, encoding = compressBody(body, compression, config.get('compression_level', 1))
+        headers['Content-Encoding'] = encoding
+        with requestSlot():
+            resp = session.post(url, data=compressed, headers=headers)
+        if not compressionRejected(resp):
+            return resp
+        print('WARNING: server rejected ' + encoding + ' request body (' + str(resp.status_code) + '), sending uncompressed from now on')
+        _compression_rejected = True
+        del headers['Content-Encoding']
+
+    if stream:
+        body = streamJSON(obj, encoder)
+    with requestSlot():
+        return session.post(url, data=body, headers=headers)
+
+# Fetch the documents matching the query, a page at a time
+def queryDocuments(token, config, collection, query, keys=None, pagesize=1000):
+    headers = {
+        "Content-Type":"application/json",
+        "Accept": "application/json",
+        "Authorization": "Bearer " + token['access_token']
+    }
+
+    docs = []
+    page = 1
+    while True:
+        url = apiURL(config) + '/meta/v3/' + config['dbname'] + '/' + collection + '?filter=' + urllib.parse.quote(json.dumps(query))
+        if keys:
+            url += '&keys=' + urllib.parse.quote(json.dumps(keys))
+        url += '&page=' + str(page) + '&pagesize=' + str(pagesize)
+        resp = getSession(config).get(url, headers=headers)
+        if not resp.ok:
+            raise RuntimeError('query failed (' + str(resp.status_code) + '): ' + resp.text)
+        result = resp.json()
+        if isinstance(result, dict):
+            result = result.get('_embedded', [])
+        docs.extend(result)
+        if len(result) < pagesize:
+            return docs
+        page += 1
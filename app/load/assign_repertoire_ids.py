@@ -12,8 +12,8 @@ from dotenv import load_dotenv
 import os
 import airr
 import yaml
-import requests
 import argparse
+from adc_client import getToken, getSession
 
 # Setup
 # This is to access the Meta/V2 API
@@ -30,25 +30,6 @@ def getConfig():
         print('ERROR: loading config')
         return None
 
-# Fetches a user token based on the supplied auth object
-# and returns the auth object with token data on success
-def getToken(config):
-    data = {
-        "grant_type":"password",
-        "scope":"PRODUCTION",
-        "username":config['username'],
-        "password":config['password']
-    }
-    headers = {
-        "Content-Type":"application/x-www-form-urlencoded"
-    }
-
-    url = 'https://' + config['api_server'] + '/token'
-
-    resp = requests.post(url, data=data, headers=headers, auth=(config['api_key'], config['api_secret']))
-    token = resp.json()
-    return token
-
 # Insert a repertoire, assign its repertoire_id, then update it
 def insertRepertoire(token, config, rep):
     headers = {
@@ -60,7 +41,7 @@ def insertRepertoire(token, config, rep):
     # insert the repertoire
     url = 'https://' + config['api_server'] + '/meta/v2/data'
     data = { 'name': 'repertoire', 'value': rep, 'associationIds': [ rep['study']['vdjserver_uuid'] ] }
-    resp = requests.post(url, json=data, headers=headers)
+    resp = getSession(config).post(url, json=data, headers=headers)
     #print(resp.status_code)
     if resp.status_code != 201:
         print('ERROR: Expected 201 status code, got ' + resp.status_code)
@@ -84,7 +65,7 @@ def updateRepertoire(token, config, rep):
     print('Updating metadata with uuid: ' + rep['repertoire_id'])
     url = 'https://' + config['api_server'] + '/meta/v2/data/' + rep['repertoire_id']
     data = { 'name': 'repertoire', 'value': rep, 'associationIds': [ rep['study']['vdjserver_uuid'] ] }
-    resp = requests.post(url, json=data, headers=headers)
+    resp = getSession(config).post(url, json=data, headers=headers)
     #print(resp.status_code)
     if resp.status_code != 200:
         print('ERROR: Expected 200 status code, got ' + resp.status_code)
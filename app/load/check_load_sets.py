@@ -4,45 +4,13 @@
 #
 
 import json
-from dotenv import load_dotenv
-import os
 import airr
 import yaml
-import requests
+import sys
 import argparse
-
-# Setup
-def getConfig():
-    if load_dotenv(dotenv_path='/api-js-tapis/.env'):
-        cfg = {}
-        cfg['api_server'] = os.getenv('WSO2_HOST')
-        cfg['api_key'] = os.getenv('WSO2_CLIENT_KEY')
-        cfg['api_secret'] = os.getenv('WSO2_CLIENT_SECRET')
-        cfg['username'] = os.getenv('VDJ_SERVICE_ACCOUNT')
-        cfg['password'] = os.getenv('VDJ_SERVICE_ACCOUNT_SECRET')
-        return cfg
-    else:
-        print('ERROR: loading config')
-        return None
-
-# Fetches a user token based on the supplied auth object
-# and returns the auth object with token data on success
-def getToken(config):
-    data = {
-        "grant_type":"password",
-        "scope":"PRODUCTION",
-        "username":config['username'],
-        "password":config['password']
-    }
-    headers = {
-        "Content-Type":"application/x-www-form-urlencoded"
-    }
-
-    url = 'https://' + config['api_server'] + '/token'
-
-    resp = requests.post(url, data=data, headers=headers, auth=(config['api_key'], config['api_secret']))
-    token = resp.json()
-    return token
+from adc_client import getConfig, getToken, getSession
+from load_sets import expectedLoadSets, verifyLoadSets, printLoadSetHistogram, printLoadSetProblems
+from load_plan import readLoadPlan
 
 # count number of rearrangements for repertoire
 def countRearrangements(token, config, repertoire_id, load_set):
@@ -77,23 +45,72 @@ def countRearrangements(token, config, repertoire_id, load_set):
     url = 'https://vdjserver.org/airr/v1/rearrangement'
     data = query
     #print(data)
-    resp = requests.post(url, json=data, headers=headers)
+    resp = getSession(config).post(url, json=data, headers=headers)
     result = resp.json()
     print(result['Facet'])
     return result
 
+# count rearrangements in every load set of the repertoire with one facets query
+def countLoadSets(config, repertoire_id):
+    headers = {
+        "Content-Type":"application/json",
+        "Accept": "application/json"
+    }
+    query = {
+        "filters": {
+            "op":"=",
+            "content": {
+                "field":"repertoire_id",
+                "value":repertoire_id
+                }
+            },
+        "facets":"vdjserver_load_set"
+        }
+
+    url = 'https://vdjserver.org/airr/v1/rearrangement'
+    resp = getSession(config).post(url, json=query, headers=headers)
+    if not resp.ok:
+        raise RuntimeError('facets query failed (' + str(resp.status_code) + '): ' + resp.text)
+    return { r['vdjserver_load_set']: int(r['count']) for r in resp.json()['Facet'] }
+
 # main entry
 if (__name__=="__main__"):
     parser = argparse.ArgumentParser(description='Count rearrangements for load set for repertoire metadata.')
     parser.add_argument('repertoire_id', type=str, help='Repertoire identifier')
-    parser.add_argument('load_set_start', type=int, help='Load set start')
-    parser.add_argument('load_set_end', type=int, help='Load set end')
+    parser.add_argument('load_set_start', type=int, nargs='?', default=0, help='Load set start')
+    parser.add_argument('load_set_end', type=int, nargs='?', help='Load set end')
+    parser.add_argument('--verify', action='store_true', help='Count all load sets with one query grouped by load set, and report missing, short and duplicated load sets')
+    parser.add_argument('--plan', type=str, help='Load plan from load_plan.py with the expected rows of each load set, for --verify')
+    parser.add_argument('--load-set-size', type=int, default=1000, help='Rows per load set, for --verify without --plan (default: 1000)')
+    parser.add_argument('--histogram', action='store_true', help='Print the count of every load set for --verify')
     args = parser.parse_args()
 
     if args:
         config = getConfig()
         token = getToken(config)
 
+        if args.verify:
+            expected = None
+            load_set_size = args.load_set_size
+            if args.plan:
+                plan = readLoadPlan(args.plan)
+                load_set_size = plan['load_set_size']
+                expected = expectedLoadSets(plan, args.repertoire_id)
+                if expected is None:
+                    print('ERROR: plan does not have repertoire: ' + args.repertoire_id)
+                    sys.exit(1)
+            counts = countLoadSets(config, args.repertoire_id)
+            if args.histogram:
+                printLoadSetHistogram(counts, expected)
+            problems = verifyLoadSets(counts, load_set_size, args.load_set_start, args.load_set_end, expected)
+            printLoadSetProblems(args.repertoire_id, counts, problems)
+            if len(problems) > 0:
+                sys.exit(1)
+            sys.exit(0)
+
+        if args.load_set_end is None:
+            parser.error('load_set_end is required without --verify')
+
         for load_set in range(args.load_set_start,args.load_set_end):
             total = 0
             result = countRearrangements(token, config, args.repertoire_id, load_set)
@@ -1,101 +1,133 @@
 #
-# Check rearrangement load sets for a repertoire.
-# This assumes you are running in the docker container.
+# Find orphaned rearrangements, those whose repertoire_id is not in the
+# repertoire collection. This assumes you are running in the docker container.
+#
+# The repertoire_id values in the rearrangement collection are counted
+# with one facets query over the whole collection, which groups on the
+# repertoire_id index, and the repertoire ids are fetched with only the
+# repertoire_id key. The two are compared locally, and the orphaned ids
+# are reported with their number of rearrangements.
+#
+# With --delete, the orphaned rearrangements are deleted one load set at
+# a time, several at once, so no single delete request has to remove a
+# whole repertoire. Rearrangements without a load set are deleted last,
+# and rearrangements without a repertoire_id are only reported. The ids
+# to delete must be listed with --ids, or all of them confirmed with --yes,
+# and nothing is deleted if no repertoires are found, as a wrong
+# repertoire collection would make every rearrangement look orphaned.
 #
 
 import json
-from dotenv import load_dotenv
-import os
-import airr
-import yaml
-import requests
+import sys
+import time
 import argparse
+import concurrent.futures
+import requests
+from adc_client import apiConfig, apiURL, getToken, getSession, queryDocuments
+from load_sets import countLoadSets
+from rearrangement_load import deleteLoadSet, deleteRearrangements
 
-# Setup
-def getConfig():
-    if load_dotenv(dotenv_path='/api-js-tapis/.env'):
-        cfg = {}
-        cfg['api_server'] = os.getenv('WSO2_HOST')
-        cfg['api_key'] = os.getenv('WSO2_CLIENT_KEY')
-        cfg['api_secret'] = os.getenv('WSO2_CLIENT_SECRET')
-        cfg['username'] = os.getenv('VDJ_SERVICE_ACCOUNT')
-        cfg['password'] = os.getenv('VDJ_SERVICE_ACCOUNT_SECRET')
-        return cfg
-    else:
-        print('ERROR: loading config')
-        return None
-
-# Fetches a user token based on the supplied auth object
-# and returns the auth object with token data on success
-def getToken(config):
-    data = {
-        "grant_type":"password",
-        "scope":"PRODUCTION",
-        "username":config['username'],
-        "password":config['password']
-    }
+# count rearrangements for every repertoire_id in the collection,
+# returns a dictionary of repertoire_id to count
+def countRepertoireIds(token, config, collection):
     headers = {
-        "Content-Type":"application/x-www-form-urlencoded"
+        "Content-Type":"application/json",
+        "Accept": "application/json",
+        "Authorization": "Bearer " + token['access_token']
     }
 
-    url = 'https://' + config['api_server'] + '/token'
+    avars = { "match": {}, "field": '$repertoire_id' }
+    avars = requests.utils.quote(json.dumps(avars))
+    url = apiURL(config) + '/meta/v3/' + config['dbname'] + '/' + collection + '/_aggrs/' + 'facets?avars=' + avars
+    resp = getSession(config).get(url, headers=headers)
+    if not resp.ok:
+        raise RuntimeError('facets query failed (' + str(resp.status_code) + '): ' + resp.text)
+    return { r['_id']: r['count'] for r in resp.json() }
 
-    resp = requests.post(url, data=data, headers=headers, auth=(config['api_key'], config['api_secret']))
-    token = resp.json()
-    return token
+# repertoire_id of every repertoire in the collection
+def getRepertoireIds(token, config, collection='repertoire'):
+    docs = queryDocuments(token, config, collection, {}, keys={ "repertoire_id": 1 })
+    return set([ d.get('repertoire_id') for d in docs ])
 
-def getRepertoires(token, config, collection):
-    headers = {
-        "Content-Type":"application/json",
-        "Accept": "application/json"
-    }
-    query = { "fields": ["repertoire_id"] }
-    url = 'https://vdjserver.org/airr/v1/repertoire'
-    data = query
-    #print(data)
-    resp = requests.post(url, json=data, headers=headers)
-    result = resp.json()
-    print(result)
-    return result
+# Repertoire ids with rearrangements but no repertoire,
+# returns a list of (repertoire_id, count) by count
+def orphanedRepertoires(counts, repertoire_ids):
+    orphans = [ (k, v) for k, v in counts.items() if k not in repertoire_ids ]
+    return sorted(orphans, key=lambda x: (-x[1], str(x[0])))
 
-# count number of rearrangements for repertoire
-def extraRearrangements(token, config, repertoires):
-    headers = {
-        "Content-Type":"application/json",
-        "Accept": "application/json"
-    }
-    query = {
-        "filters": {
-            "op":"exclude",
-            "content": {
-                "field":"repertoire_id",
-                "value": [repertoires]
-                }
-            }
-        }
+# Delete the rearrangements of an orphaned repertoire a load set at a time,
+# returns the number of load sets that failed to delete
+def deleteOrphan(token, config, collection, repertoire_id, workers):
+    load_sets = countLoadSets(token, config, collection, repertoire_id)
+    print('Deleting ' + str(sum(load_sets.values())) + ' rearrangements in ' + str(len(load_sets)) + ' load sets for repertoire: ' + repertoire_id)
+    failed = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        chunks = sorted([ k for k in load_sets if k is not None ])
+        for load_set, ok in zip(chunks, pool.map(lambda ls: deleteLoadSet(token, config, repertoire_id, ls, collection), chunks)):
+            if not ok:
+                print('ERROR: could not delete load set ' + str(load_set) + ' for repertoire: ' + repertoire_id)
+                failed += 1
+    if None in load_sets:
+        deleteRearrangements(token, config, repertoire_id, collection)
+    return failed
 
-    # perform facets query
-    url = 'https://vdjserver.org/airr/v1/rearrangement'
-    data = query
-    #print(data)
-    resp = requests.post(url, json=data, headers=headers)
-    result = resp.json()
-    print(result)
-    return result
+def printOrphans(orphans, total):
+    print('repertoire_id\trearrangements')
+    for repertoire_id, count in orphans:
+        print(str(repertoire_id) + '\t' + str(count))
+    print(str(len(orphans)) + ' orphaned repertoire ids with ' + str(sum([ c for r, c in orphans ])) + ' of ' + str(total) + ' rearrangements')
 
 # main entry
 if (__name__=="__main__"):
-    parser = argparse.ArgumentParser(description='Extra rearrangements.')
-    parser.add_argument('collection', type=str, help='Collection suffix')
+    parser = argparse.ArgumentParser(description='Find rearrangements whose repertoire is not in the repository.')
+    parser.add_argument('collection', type=str, nargs='?', default='rearrangement', help='Rearrangement collection (default: rearrangement)')
+    parser.add_argument('--repertoire-collection', type=str, default='repertoire', help='Repertoire collection (default: repertoire)')
+    parser.add_argument('--delete', action='store_true', help='Delete the orphaned rearrangements a load set at a time, with --ids or --yes')
+    parser.add_argument('--ids', type=str, help='Comma separated orphaned repertoire ids to delete')
+    parser.add_argument('--yes', action='store_true', help='Delete all of the orphaned repertoire ids that are found')
+    parser.add_argument('--workers', type=int, default=4, help='Number of deletes at once (default: 4)')
+    parser.add_argument('--api-url', type=str, help='Base URL of the API server instead of the .env file')
     args = parser.parse_args()
 
     if args:
-        config = getConfig()
+        if args.delete and not args.ids and not args.yes:
+            print('ERROR: --delete needs the repertoire ids to delete with --ids, or --yes to delete all of the orphaned ids')
+            sys.exit(1)
+        config = apiConfig(args.api_url)
+        if config is None:
+            sys.exit(1)
+        config['pool_size'] = max(config['pool_size'], args.workers)
         token = getToken(config)
 
-        result = getRepertoires(token, config, args.collection)
-        print(len(result['Repertoire']))
-        reps = [ v['repertoire_id'] for v in result['Repertoire'] ]
-        print(reps)
-        print(len(reps))
-        result = extraRearrangements(token, config, reps)
+        t = time.time()
+        counts = countRepertoireIds(token, config, args.collection)
+        repertoire_ids = getRepertoireIds(token, config, args.repertoire_collection)
+        print('Found ' + str(len(counts)) + ' repertoire ids in ' + args.collection + ' and ' + str(len(repertoire_ids)) + ' repertoires in '
+              + args.repertoire_collection + ' in ' + '{:.1f}'.format(time.time() - t) + ' secs')
+        orphans = orphanedRepertoires(counts, repertoire_ids)
+        printOrphans(orphans, sum(counts.values()))
+
+        if args.delete:
+            if len(repertoire_ids) == 0:
+                print('ERROR: no repertoires found in ' + args.repertoire_collection + ', not deleting anything')
+                sys.exit(1)
+            if args.ids:
+                orphan_ids = set([ r for r, c in orphans ])
+                delete_ids = args.ids.split(',')
+                others = [ r for r in delete_ids if r not in orphan_ids ]
+                if len(others) > 0:
+                    print('ERROR: not orphaned, not deleting anything: ' + ', '.join(others))
+                    sys.exit(1)
+                orphans = [ (r, c) for r, c in orphans if r in delete_ids ]
+            failed = 0
+            for repertoire_id, count in orphans:
+                if repertoire_id is None:
+                    print('WARNING: not deleting ' + str(count) + ' rearrangements without a repertoire_id')
+                    continue
+                failed += deleteOrphan(token, config, args.collection, repertoire_id, args.workers)
+            counts = countRepertoireIds(token, config, args.collection)
+            print('After delete:')
+            printOrphans(orphanedRepertoires(counts, repertoire_ids), sum(counts.values()))
+            if failed > 0:
+                print('ERROR: ' + str(failed) + ' load sets could not be deleted')
+                sys.exit(1)
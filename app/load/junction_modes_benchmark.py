@@ -0,0 +1,105 @@
+#
+# Benchmark the junction_aa substring modes of rearrangement_load.py.
+#
+# For each mode, the rows of an AIRR TSV file are transformed as the loader
+# would, and the transform rate, insert payload bytes and the number and
+# bytes of keys added to the multikey junction index are reported. The
+# gateway does not expose index statistics, so the index size is estimated
+# from the keys. With --collection, each mode is also inserted into that
+# scratch collection to measure the insert rate, then deleted again.
+#
+# This assumes you are running in the docker container.
+#
+
+import json
+import argparse
+import time
+import airr
+from adc_client import getConfig, getToken
+from rearrangement_load import transformLoadSet, insertRearrangement, deleteRearrangements, default_transform_options, junction_modes
+
+# read the raw rows once, they are copied for each mode
+def readRows(filename, limit):
+    rows = []
+    reader = airr.read_rearrangement(filename)
+    for r in reader:
+        rows.append(r)
+        if limit and len(rows) >= limit:
+            break
+    return rows
+
+def benchmarkMode(rows, mode, max_length, load_set_size, token, config, collection):
+    options = dict(default_transform_options)
+    options['junction_mode'] = mode
+    options['junction_max_length'] = max_length
+    repertoire_id = 'junction-benchmark-' + mode
+
+    load_sets = []
+    t = time.time()
+    for i in range(0, len(rows), load_set_size):
+        records = [ dict(r) for r in rows[i:i+load_set_size] ]
+        load_sets.append(transformLoadSet(records, repertoire_id, 'junction-benchmark', len(load_sets), options))
+    transform_time = time.time() - t
+
+    payload_bytes = 0
+    index_keys = 0
+    index_bytes = 0
+    for records in load_sets:
+        payload_bytes += len(json.dumps(records))
+        for r in records:
+            for field in [ 'vdjserver_junction_substrings', 'vdjserver_junction_suffixes' ]:
+                if r.get(field):
+                    index_keys += len(r[field])
+                    index_bytes += sum(len(v) for v in r[field])
+
+    result = {
+        "mode": mode,
+        "records": len(rows),
+        "transform_rate": len(rows) / transform_time if transform_time > 0 else 0,
+        "payload_bytes": payload_bytes,
+        "index_keys": index_keys,
+        "index_bytes": index_bytes,
+        "insert_rate": None
+    }
+
+    if collection:
+        t = time.time()
+        for records in load_sets:
+            insertRearrangement(token, config, records, collection)
+        insert_time = time.time() - t
+        result['insert_rate'] = len(rows) / insert_time if insert_time > 0 else 0
+        deleteRearrangements(token, config, repertoire_id, collection)
+
+    return result
+
+# main entry
+if (__name__=="__main__"):
+    parser = argparse.ArgumentParser(description='Benchmark junction_aa substring modes for rearrangement loading.')
+    parser.add_argument('airr_file', type=str, help='AIRR rearrangement TSV file')
+    parser.add_argument('--limit', type=int, default=100000, help='Maximum number of rows to use (default: 100000)')
+    parser.add_argument('--load-set-size', type=int, default=1000, help='Rows per load set (default: 1000)')
+    parser.add_argument('--junction-max-length', type=int, default=8, help='Maximum substring length for max mode (default: 8)')
+    parser.add_argument('--collection', type=str, help='Scratch collection to measure insert rate, nothing is inserted if not given')
+    args = parser.parse_args()
+
+    if args:
+        rows = readRows(args.airr_file, args.limit)
+        print('Read ' + str(len(rows)) + ' rows from ' + args.airr_file)
+
+        config = None
+        token = None
+        if args.collection:
+            config = getConfig()
+            token = getToken(config)
+
+        results = []
+        for mode in junction_modes:
+            results.append(benchmarkMode(rows, mode, args.junction_max_length, args.load_set_size, token, config, args.collection))
+
+        base = results[0]
+        print('mode\trows/sec\tpayload_bytes\tpayload_ratio\tindex_keys\tindex_bytes\tinsert_rows/sec')
+        for r in results:
+            insert_rate = '-' if r['insert_rate'] is None else '{:.1f}'.format(r['insert_rate'])
+            print(r['mode'] + '\t' + '{:.1f}'.format(r['transform_rate']) + '\t' + str(r['payload_bytes'])
+                  + '\t' + '{:.3f}'.format(r['payload_bytes'] / base['payload_bytes'])
+                  + '\t' + str(r['index_keys']) + '\t' + str(r['index_bytes']) + '\t' + insert_rate)
@@ -5,46 +5,16 @@
 #
 
 import json
-from dotenv import load_dotenv
 import os
+import sys
 import airr
 import yaml
 import requests
 import argparse
-
-# Setup
-def getConfig():
-    if load_dotenv(dotenv_path='/api-js-tapis/.env'):
-        cfg = {}
-        cfg['api_server'] = os.getenv('WSO2_HOST')
-        cfg['api_key'] = os.getenv('WSO2_CLIENT_KEY')
-        cfg['api_secret'] = os.getenv('WSO2_CLIENT_SECRET')
-        cfg['username'] = os.getenv('VDJ_SERVICE_ACCOUNT')
-        cfg['password'] = os.getenv('VDJ_SERVICE_ACCOUNT_SECRET')
-        cfg['dbname'] = os.getenv('MONGODB_DB')
-        return cfg
-    else:
-        print('ERROR: loading config')
-        return None
-
-# Fetches a user token based on the supplied auth object
-# and returns the auth object with token data on success
-def getToken(config):
-    data = {
-        "grant_type":"password",
-        "scope":"PRODUCTION",
-        "username":config['username'],
-        "password":config['password']
-    }
-    headers = {
-        "Content-Type":"application/x-www-form-urlencoded"
-    }
-
-    url = 'https://' + config['api_server'] + '/token'
-
-    resp = requests.post(url, data=data, headers=headers, auth=(config['api_key'], config['api_secret']))
-    token = resp.json()
-    return token
+import concurrent.futures
+import time
+from adc_client import apiConfig, apiURL, getToken, getSession
+from rearrangement_files import repertoireFiles, countRowsInFiles, countRepertoireFiles
 
 # count number of rearrangements for repertoire
 def countRearrangements(token, config, collection, rep):
@@ -59,9 +29,9 @@ def countRearrangements(token, config, collection, rep):
     field = '$repertoire_id'
     avars = { "match": query, "field": field }
     avars = requests.utils.quote(json.dumps(avars))
-    url = 'https://' + config['api_server'] + '/meta/v3/' + config['dbname'] + '/' + collection + '/_aggrs/' + 'facets?avars=' + avars
+    url = apiURL(config) + '/meta/v3/' + config['dbname'] + '/' + collection + '/_aggrs/' + 'facets?avars=' + avars
     #print(url)
-    resp = requests.get(url, headers=headers)
+    resp = getSession(config).get(url, headers=headers)
 
     result = resp.json()
     #print(result)
@@ -70,36 +40,69 @@ def countRearrangements(token, config, collection, rep):
     else:
         return result[0]['count']
 
-# count number of rearrangements for repertoire
-def countRearrangementsInFiles(token, config, rep, file_prefix):
-    primary_dp = None
-    for dp in rep['data_processing']:
-        if dp.get('primary_annotation'):
-            primary_dp = dp
-        if not primary_dp:
-            print('ERROR: Repertoire missing primary data processing: ' + rep['repertoire_id'])
-            sys.exit(1)
+# keep the facets query URLs well under the server limits
+max_avars_length = 6000
+
+# Split the repertoire_ids into chunks whose facets query fits in a URL
+def repertoireChunks(repertoire_ids, max_length=max_avars_length):
+    chunks = []
+    chunk = []
+    length = 0
+    for repertoire_id in repertoire_ids:
+        id_length = len(requests.utils.quote(json.dumps(repertoire_id))) + 3
+        if len(chunk) > 0 and length + id_length > max_length:
+            chunks.append(chunk)
+            chunk = []
+            length = 0
+        chunk.append(repertoire_id)
+        length += id_length
+    if len(chunk) > 0:
+        chunks.append(chunk)
+    return chunks
+
+# count rearrangements for a chunk of repertoires with one facets query
+def countRepertoireChunk(token, config, collection, repertoire_ids, attempts=3):
+    headers = {
+        "Content-Type":"application/json",
+        "Accept": "application/json",
+        "Authorization": "Bearer " + token['access_token']
+    }
 
-    total = 0
-    files = primary_dp['data_processing_files']
-    for f in files:
-        f = f.replace('.gz','')
-        if os.path.isfile(file_prefix + '/' + f):
-            print('AIRR rearrangement file: ' + file_prefix + '/' + f)
-            reader = open(file_prefix + '/' + f, 'r')
-        elif os.path.isfile(file_prefix + '/' + primary_dp['data_processing_id'] + '/' + f):
-            print('AIRR rearrangement file: ' + file_prefix + '/' + primary_dp['data_processing_id'] + '/' + f)
-            reader = open(file_prefix + '/' + primary_dp['data_processing_id'] + '/' + f, 'r')
-        else:
-            print('ERROR: cannot find file: ' + f)
-            sys.exit(1)
+    query = { "repertoire_id": { "$in": repertoire_ids } }
+    avars = { "match": query, "field": '$repertoire_id' }
+    avars = requests.utils.quote(json.dumps(avars))
+    url = apiURL(config) + '/meta/v3/' + config['dbname'] + '/' + collection + '/_aggrs/' + 'facets?avars=' + avars
+    for attempt in range(attempts):
+        resp = getSession(config).get(url, headers=headers)
+        if resp.ok:
+            return { r['_id']: r['count'] for r in resp.json() }
+        print('WARNING: facets query failed (' + str(resp.status_code) + '), attempt ' + str(attempt + 1) + ' of ' + str(attempts))
+        time.sleep(2 ** attempt)
+    raise RuntimeError('facets query failed for ' + str(len(repertoire_ids)) + ' repertoires: ' + resp.text)
+
+# count rearrangements for all of the repertoires, grouped by repertoire_id
+# in one facets query per chunk, with several chunks at once
+def countRearrangementsBatch(token, config, collection, repertoire_ids, workers=4):
+    counts = { repertoire_id: 0 for repertoire_id in repertoire_ids }
+    chunks = repertoireChunks(repertoire_ids)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        for result in pool.map(lambda chunk: countRepertoireChunk(token, config, collection, chunk), chunks):
+            for repertoire_id, count in result.items():
+                if repertoire_id in counts:
+                    counts[repertoire_id] = count
+    return counts
+
+# count number of rearrangements for repertoire, file_counts has
+# the rows of the files if they were already counted
+def countRearrangementsInFiles(token, config, rep, file_prefix, file_counts=None):
+    filenames = repertoireFiles(rep, file_prefix)
+    if file_counts is None:
+        file_counts = countRowsInFiles(filenames)
 
-        # count lines, subtract header
-        cnt = 0
-        records = []
-        for line in reader:
-            cnt += 1
-        if cnt > 0: cnt -= 1
+    total = 0
+    for filename in filenames:
+        print('AIRR rearrangement file: ' + filename)
+        cnt = file_counts[filename]
         total += cnt
         print('File count: ' + str(cnt))
     print('Total count: ' + str(total))
@@ -111,18 +114,24 @@ if (__name__=="__main__"):
     parser.add_argument('collection', type=str, help='Rearrangement collection')
     parser.add_argument('repertoire_file', type=str, help='Repertoire metadata file name')
     parser.add_argument('--file_prefix', type=str, help='Directory prefix to find the rearrangements files')
+    parser.add_argument('--processes', type=int, default=os.cpu_count(), help='Number of files to count at once (default: number of CPUs)')
+    parser.add_argument('--recount', action='store_true', help='Count the rows of files that have an up to date load set index')
+    parser.add_argument('--batch', action='store_true', help='Count all of the repertoires with one facets query per chunk of repertoires')
+    parser.add_argument('--workers', type=int, default=4, help='Number of chunks to query at once for --batch (default: 4)')
+    parser.add_argument('--api-url', type=str, help='Base URL of the API server instead of the .env file')
     args = parser.parse_args()
 
     if args:
         data = airr.load_repertoire(args.repertoire_file)
 
-        config = getConfig()
+        config = apiConfig(args.api_url)
+        if config is None:
+            sys.exit(1)
+        config['pool_size'] = max(config['pool_size'], args.workers)
         token = getToken(config)
         #print(token)
 
         reps = data['Repertoire']
-
-        total = 0
         for r in reps:
             if r.get('repertoire_id') is None:
                 print('Repertoire is missing repertoire_id')
@@ -130,11 +139,30 @@ if (__name__=="__main__"):
             if len(r['repertoire_id']) == 0:
                 print('Repertoire is missing repertoire_id')
                 sys.exit(0)
-            result = countRearrangements(token, config, args.collection, r)
+
+        # count the files first, all of them at once
+        file_counts = None
+        if args.file_prefix:
+            t = time.time()
+            file_counts = countRepertoireFiles(reps, args.file_prefix, args.processes, not args.recount)
+            print('Counted rows of ' + str(len(file_counts)) + ' files in ' + '{:.1f}'.format(time.time() - t) + ' secs')
+
+        counts = None
+        if args.batch:
+            t = time.time()
+            counts = countRearrangementsBatch(token, config, args.collection, [ r['repertoire_id'] for r in reps ], args.workers)
+            print('Counted ' + str(len(counts)) + ' repertoires in ' + '{:.1f}'.format(time.time() - t) + ' secs')
+
+        total = 0
+        for r in reps:
+            if counts is not None:
+                result = counts[r['repertoire_id']]
+            else:
+                result = countRearrangements(token, config, args.collection, r)
             print('Repertoire', r['repertoire_id'], 'has rearrangement count:', result)
             total += result
             if args.file_prefix:
-                cnt = countRearrangementsInFiles(token, config, r, args.file_prefix)
+                cnt = countRearrangementsInFiles(token, config, r, args.file_prefix, file_counts)
                 if cnt != result:
                     print('ERROR: database count != file count')
         print("Total rearrangements: " + str(total))
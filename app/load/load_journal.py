@@ -0,0 +1,87 @@
+#
+# Local journal of the rearrangement load sets acknowledged by the server.
+#
+# Each load set is recorded as started before it is uploaded, then as
+# inserted with the number of records the server acknowledged. A resumed
+# load skips the load sets that were fully inserted, and reloads the ones
+# that were started or only partially inserted after deleting them.
+#
+# The journal is a SQLite file so it is safe if the loader is killed,
+# and a single journal can hold many repertoires, including from
+# several loader processes at once.
+#
+# The journal also keeps a digest of the contents of each load set, so an
+# incremental reload only replaces the load sets that changed.
+#
+
+import sqlite3
+import threading
+import time
+
+def openLoadJournal(filename):
+    db = sqlite3.connect(filename, timeout=60, check_same_thread=False)
+    db.execute('CREATE TABLE IF NOT EXISTS load_sets (repertoire_id TEXT, load_set INTEGER, status TEXT, records INTEGER, inserted INTEGER, updated REAL, digest TEXT, PRIMARY KEY (repertoire_id, load_set))')
+    # journals from before digests were kept
+    columns = [ row[1] for row in db.execute('PRAGMA table_info(load_sets)') ]
+    if 'digest' not in columns:
+        db.execute('ALTER TABLE load_sets ADD COLUMN digest TEXT')
+    db.commit()
+    return { "db": db, "lock": threading.Lock(), "filename": filename }
+
+def closeLoadJournal(journal):
+    with journal['lock']:
+        journal['db'].close()
+
+# the digest is kept when the status is updated
+def journalUpdate(journal, repertoire_id, load_set, status, records, inserted):
+    with journal['lock']:
+        journal['db'].execute('INSERT INTO load_sets (repertoire_id, load_set, status, records, inserted, updated) VALUES (?, ?, ?, ?, ?, ?)'
+                              + ' ON CONFLICT (repertoire_id, load_set) DO UPDATE SET status = excluded.status, records = excluded.records, inserted = excluded.inserted, updated = excluded.updated',
+                              (repertoire_id, load_set, status, records, inserted, time.time()))
+        journal['db'].commit()
+
+# Record the digest of a load set that is about to be uploaded, it
+# stays started until journalInserted() records the upload
+def journalDigest(journal, repertoire_id, load_set, records, digest):
+    with journal['lock']:
+        journal['db'].execute('INSERT OR REPLACE INTO load_sets VALUES (?, ?, ?, ?, ?, ?, ?)',
+                              (repertoire_id, load_set, 'started', records, 0, time.time(), digest))
+        journal['db'].commit()
+
+# Record that a load set is about to be uploaded
+def journalStarted(journal, repertoire_id, load_set, records):
+    journalUpdate(journal, repertoire_id, load_set, 'started', records, 0)
+
+# Record the number of records the server acknowledged for the load set
+def journalInserted(journal, repertoire_id, load_set, records, inserted):
+    if inserted == records:
+        status = 'inserted'
+    else:
+        status = 'failed'
+    journalUpdate(journal, repertoire_id, load_set, status, records, inserted)
+
+# Get the status of all load sets for a repertoire, as a
+# dictionary of load_set to (status, records, inserted, digest)
+def journalLoadSets(journal, repertoire_id):
+    with journal['lock']:
+        rows = journal['db'].execute('SELECT load_set, status, records, inserted, digest FROM load_sets WHERE repertoire_id = ?', (repertoire_id,)).fetchall()
+    return { row[0]: (row[1], row[2], row[3], row[4]) for row in rows }
+
+# Load sets that were fully inserted
+def journalCompleted(journal, repertoire_id):
+    return set(k for k, v in journalLoadSets(journal, repertoire_id).items() if v[0] == 'inserted')
+
+# Load sets that were started or partially inserted, these may
+# have some records in the database
+def journalIncomplete(journal, repertoire_id):
+    return set(k for k, v in journalLoadSets(journal, repertoire_id).items() if v[0] != 'inserted')
+
+# Remove load sets from the journal, all of them for the repertoire
+# if load_set_start is 0, otherwise from load_set_start up to load_set_end
+def journalReset(journal, repertoire_id, load_set_start=0, load_set_end=None):
+    with journal['lock']:
+        if load_set_end is None:
+            journal['db'].execute('DELETE FROM load_sets WHERE repertoire_id = ? AND load_set >= ?', (repertoire_id, load_set_start))
+        else:
+            journal['db'].execute('DELETE FROM load_sets WHERE repertoire_id = ? AND load_set >= ? AND load_set < ?', (repertoire_id, load_set_start, load_set_end))
+        journal['db'].commit()
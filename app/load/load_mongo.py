@@ -0,0 +1,53 @@
+#
+# Direct MongoDB backend for the rearrangement loader, for operators with
+# access to the database. Rearrangements are inserted with unordered
+# insert_many and deleted with delete_many instead of going through the
+# Meta V3 gateway, with the same transform and load set handling.
+#
+# The write concern can be relaxed for bulk loads, such as w=1 without
+# journaling, at the risk of losing the most recent load sets if the
+# server fails. A load journal with --resume will reload those.
+#
+
+# pymongo is only needed for this backend
+try:
+    import pymongo
+    import pymongo.errors
+    import pymongo.write_concern
+except ImportError:
+    pymongo = None
+
+# w can be a number of members or a tag such as majority
+def parseWriteConcern(w, journal=None):
+    if w is None:
+        return pymongo.write_concern.WriteConcern(j=journal)
+    if w.isdigit():
+        w = int(w)
+    return pymongo.write_concern.WriteConcern(w=w, j=journal)
+
+def openMongoBackend(uri, dbname, w=None, journal=None, pool_size=10):
+    if pymongo is None:
+        raise RuntimeError('mongo backend requires the pymongo module')
+    client = pymongo.MongoClient(uri, maxPoolSize=pool_size)
+    db = client.get_database(dbname, write_concern=parseWriteConcern(w, journal))
+    return { "client": client, "db": db, "uri": uri }
+
+def closeMongoBackend(backend):
+    backend['client'].close()
+
+# Insert the records, returns the number inserted. With an unordered
+# insert the other records are still inserted if some of them fail.
+def mongoInsert(backend, records, collection='rearrangement'):
+    if len(records) == 0:
+        return 0
+    try:
+        result = backend['db'][collection].insert_many(records, ordered=False)
+        return len(result.inserted_ids)
+    except pymongo.errors.BulkWriteError as e:
+        print('ERROR: ' + str(len(e.details.get('writeErrors', []))) + ' records failed to insert: ' + str(e.details.get('writeErrors', [])[:1]))
+        return e.details.get('nInserted', 0)
+
+# Delete the documents matching the filter, returns the number deleted
+def mongoDelete(backend, query, collection='rearrangement'):
+    result = backend['db'][collection].delete_many(query)
+    return result.deleted_count
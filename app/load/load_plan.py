@@ -0,0 +1,160 @@
+#
+# Plan the load of the rearrangements for the repertoires in a
+# repertoire file, before loading them.
+#
+# Every file in the data_processing_files of each repertoire is scanned
+# for its rows and load set offsets, in parallel, which builds (or reuses)
+# the load set index of the file. The plan has the rows, load sets and
+# bytes of each repertoire and file, and splits each repertoire into work
+# units of consecutive load sets that can be loaded independently, with
+# rearrangement_load.py --plan <plan> --work-unit <n>.
+#
+#   {
+#     "repertoire_file": "...",
+#     "file_prefix": "...",
+#     "load_set_size": 1000,
+#     "rows": 1234567, "load_sets": 1235, "bytes": 987654321,
+#     "repertoires": [
+#       { "repertoire_id": "...", "rows": ..., "load_sets": ..., "bytes": ...,
+#         "files": [ { "file": "...", "rows": ..., "bytes": ..., "first_load_set": 0, "load_sets": ... } ] }
+#     ],
+#     "work_units": [
+#       { "unit": 0, "repertoire_id": "...", "load_set_start": 0, "load_set_end": 100, "rows": 100000 }
+#     ]
+#   }
+#
+# This assumes you are running in the docker container.
+#
+
+import json
+import os
+import sys
+import time
+import argparse
+import concurrent.futures
+import airr
+from rearrangement_files import getPrimaryDataProcessing, findRearrangementFile, getLoadSetIndex
+
+# Scan the files in a process pool, returns a dictionary of filename to index
+def scanFiles(filenames, load_set_size, processes=1):
+    indexes = {}
+    if processes > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as pool:
+            for filename, index in zip(filenames, pool.map(getLoadSetIndex, filenames, [ load_set_size ] * len(filenames))):
+                indexes[filename] = index
+    else:
+        for filename in filenames:
+            indexes[filename] = getLoadSetIndex(filename, load_set_size)
+    return indexes
+
+# Rows in each load set of the files, load sets do not span files
+# so the last load set of each file can be partial
+def loadSetRows(files, load_set_size):
+    rows = []
+    for f in files:
+        for i in range(0, f['load_sets']):
+            rows.append(min(load_set_size, f['rows'] - i * load_set_size))
+    return rows
+
+def makeLoadPlan(repertoire_file, file_prefix, load_set_size, unit_load_sets, processes=1):
+    data = airr.read_airr(repertoire_file)
+    reps = data['Repertoire']
+
+    # the same file might be listed for more than one repertoire
+    rep_files = []
+    filenames = []
+    for rep in reps:
+        primary_dp = getPrimaryDataProcessing(rep)
+        names = [ findRearrangementFile(file_prefix, primary_dp, f) for f in primary_dp['data_processing_files'] ]
+        rep_files.append(names)
+        for filename in names:
+            if filename not in filenames:
+                filenames.append(filename)
+    indexes = scanFiles(filenames, load_set_size, processes)
+
+    plan = {
+        "repertoire_file": repertoire_file,
+        "file_prefix": file_prefix,
+        "load_set_size": load_set_size,
+        "unit_load_sets": unit_load_sets,
+        "created": time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        "rows": 0,
+        "load_sets": 0,
+        "bytes": 0,
+        "repertoires": [],
+        "work_units": []
+    }
+    for rep, names in zip(reps, rep_files):
+        entry = { "repertoire_id": rep['repertoire_id'], "rows": 0, "load_sets": 0, "bytes": 0, "files": [] }
+        for filename in names:
+            index = indexes[filename]
+            entry['files'].append({ "file": filename, "rows": index['rows'], "bytes": index['size'],
+                                    "first_load_set": entry['load_sets'], "load_sets": len(index['offsets']) })
+            entry['rows'] += index['rows']
+            entry['load_sets'] += len(index['offsets'])
+            entry['bytes'] += index['size']
+        plan['repertoires'].append(entry)
+        plan['rows'] += entry['rows']
+        plan['load_sets'] += entry['load_sets']
+        plan['bytes'] += entry['bytes']
+
+        rows = loadSetRows(entry['files'], load_set_size)
+        for start in range(0, entry['load_sets'], unit_load_sets):
+            end = min(start + unit_load_sets, entry['load_sets'])
+            plan['work_units'].append({ "unit": len(plan['work_units']), "repertoire_id": rep['repertoire_id'],
+                                        "load_set_start": start, "load_set_end": end, "rows": sum(rows[start:end]) })
+    return plan
+
+def readLoadPlan(filename):
+    return json.load(open(filename, 'r'))
+
+def writeLoadPlan(filename, plan):
+    with open(filename, 'w') as writer:
+        json.dump(plan, writer, indent=2)
+
+def planRepertoire(plan, repertoire_id):
+    for entry in plan['repertoires']:
+        if entry['repertoire_id'] == repertoire_id:
+            return entry
+    return None
+
+# Planned rows of a repertoire from load_set_start up to load_set_end
+def planRows(plan, repertoire_id, load_set_start=0, load_set_end=None):
+    entry = planRepertoire(plan, repertoire_id)
+    if entry is None:
+        return 0
+    rows = loadSetRows(entry['files'], plan['load_set_size'])
+    return sum(rows[load_set_start:load_set_end])
+
+def printLoadPlan(plan):
+    print('repertoire_id\tfiles\trows\tload_sets\tbytes\twork_units')
+    for entry in plan['repertoires']:
+        units = len([ u for u in plan['work_units'] if u['repertoire_id'] == entry['repertoire_id'] ])
+        print(entry['repertoire_id'] + '\t' + str(len(entry['files'])) + '\t' + str(entry['rows']) + '\t' + str(entry['load_sets'])
+              + '\t' + str(entry['bytes']) + '\t' + str(units))
+    print('Total rows: ' + str(plan['rows']) + ', load sets: ' + str(plan['load_sets']) + ', bytes: ' + str(plan['bytes'])
+          + ', work units: ' + str(len(plan['work_units'])))
+
+# main entry
+if (__name__=="__main__"):
+    parser = argparse.ArgumentParser(description='Plan the load of AIRR rearrangements into work units.')
+    parser.add_argument('repertoire_file', type=str, help='AIRR repertoire metadata file name')
+    parser.add_argument('file_prefix', type=str, help='Directory prefix to find the rearrangements files')
+    parser.add_argument('plan_file', type=str, help='Load plan file to write')
+    parser.add_argument('--load-set-size', type=int, default=1000, help='Rows per load set (default: 1000)')
+    parser.add_argument('--unit-load-sets', type=int, default=100, help='Load sets per work unit (default: 100)')
+    parser.add_argument('--processes', type=int, default=os.cpu_count(), help='Number of files to scan at once (default: number of CPUs)')
+    parser.add_argument('--rate', type=float, help='Expected rows/sec, to estimate the load time')
+    args = parser.parse_args()
+
+    if args:
+        if args.unit_load_sets < 1:
+            print('ERROR: --unit-load-sets must be at least 1')
+            sys.exit(1)
+        t = time.time()
+        plan = makeLoadPlan(args.repertoire_file, args.file_prefix, args.load_set_size, args.unit_load_sets, args.processes)
+        writeLoadPlan(args.plan_file, plan)
+        printLoadPlan(plan)
+        print('Scanned in ' + '{:.1f}'.format(time.time() - t) + ' secs, wrote plan: ' + args.plan_file)
+        if args.rate:
+            print('Estimated load time: ' + '{:.1f}'.format(plan['rows'] / args.rate / 60) + ' mins at ' + str(args.rate) + ' rows/sec')
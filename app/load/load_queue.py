@@ -0,0 +1,246 @@
+#
+# Redis work queue of rearrangement load work units, so loaders on any
+# number of hosts can share the load of a study.
+#
+# A coordinator enqueues the work units of a load plan (load_plan.py),
+# each with its repertoire, file prefix and range of load sets. Workers,
+# rearrangement_load.py --worker, claim a unit with a lease that expires
+# after the visibility timeout, and keep extending it while they load.
+# If a worker dies, its lease expires and the unit goes back to the
+# queue for another worker. Enqueueing, claiming, extending, completing
+# and failing a unit are each a single Lua script, so they are atomic, and only the
+# worker holding the lease can complete a unit. Loading a range of load
+# sets deletes those load sets first, so a unit that is loaded again
+# replaces the rearrangements of the earlier attempt.
+#
+# Keys, all under adc-load:<queue name>:
+#   units     hash of unit id to unit JSON
+#   pending   list of unit ids waiting to be claimed
+#   leases    sorted set of claimed unit ids by lease expiry time
+#   owners    hash of claimed unit id to worker id
+#   attempts  hash of unit id to failed attempts
+#   done      hash of unit id to the load summary JSON
+#   failed    hash of unit id to the last error, after too many attempts
+#
+# Run as a script for the coordinator commands. This needs the redis module.
+#
+
+import json
+import os
+import sys
+import argparse
+import airr
+from load_plan import readLoadPlan
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+default_queue_url = os.getenv('ADC_LOAD_QUEUE_URL', 'redis://localhost:6379/0')
+
+# lease times use the Redis server clock so the hosts do not need to agree
+_now_lua = """
+if redis.replicate_commands then redis.replicate_commands() end
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+"""
+
+# KEYS units, pending  ARGV unit id, unit
+_enqueue_lua = """
+if redis.call('HSETNX', KEYS[1], ARGV[1], ARGV[2]) == 0 then
+    return 0
+end
+redis.call('RPUSH', KEYS[2], ARGV[1])
+return 1
+"""
+
+# KEYS pending, leases, owners, units, attempts  ARGV worker, timeout
+_claim_lua = _now_lua + """
+local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', now)
+for i, unit in ipairs(expired) do
+    redis.call('ZREM', KEYS[2], unit)
+    redis.call('HDEL', KEYS[3], unit)
+    redis.call('LPUSH', KEYS[1], unit)
+end
+local unit = redis.call('LPOP', KEYS[1])
+if not unit then
+    return nil
+end
+redis.call('ZADD', KEYS[2], now + tonumber(ARGV[2]), unit)
+redis.call('HSET', KEYS[3], unit, ARGV[1])
+return { unit, redis.call('HGET', KEYS[4], unit), redis.call('HGET', KEYS[5], unit) }
+"""
+
+# KEYS leases, owners  ARGV unit, worker, timeout
+_extend_lua = _now_lua + """
+if redis.call('HGET', KEYS[2], ARGV[1]) ~= ARGV[2] then
+    return 0
+end
+redis.call('ZADD', KEYS[1], now + tonumber(ARGV[3]), ARGV[1])
+return 1
+"""
+
+# KEYS leases, owners, done  ARGV unit, worker, result
+_complete_lua = """
+if redis.call('HGET', KEYS[2], ARGV[1]) ~= ARGV[2] then
+    return 0
+end
+redis.call('ZREM', KEYS[1], ARGV[1])
+redis.call('HDEL', KEYS[2], ARGV[1])
+redis.call('HSET', KEYS[3], ARGV[1], ARGV[3])
+return 1
+"""
+
+# KEYS leases, owners, pending, attempts, failed  ARGV unit, worker, error, max_attempts
+_fail_lua = """
+if redis.call('HGET', KEYS[2], ARGV[1]) ~= ARGV[2] then
+    return 0
+end
+redis.call('ZREM', KEYS[1], ARGV[1])
+redis.call('HDEL', KEYS[2], ARGV[1])
+local attempts = redis.call('HINCRBY', KEYS[4], ARGV[1], 1)
+if attempts >= tonumber(ARGV[4]) then
+    redis.call('HSET', KEYS[5], ARGV[1], ARGV[3])
+else
+    redis.call('RPUSH', KEYS[3], ARGV[1])
+end
+return attempts
+"""
+
+def openLoadQueue(url=default_queue_url, name='rearrangement'):
+    if redis is None:
+        raise RuntimeError('load queue requires the redis module')
+    client = redis.Redis.from_url(url, decode_responses=True)
+    return {
+        "client": client,
+        "name": name,
+        "prefix": 'adc-load:' + name + ':',
+        "enqueue": client.register_script(_enqueue_lua),
+        "claim": client.register_script(_claim_lua),
+        "extend": client.register_script(_extend_lua),
+        "complete": client.register_script(_complete_lua),
+        "fail": client.register_script(_fail_lua)
+    }
+
+def queueKey(queue, key):
+    return queue['prefix'] + key
+
+# The unit id names the load sets, so enqueueing the same plan again
+# does not add units that are already queued or done
+def unitId(unit):
+    return unit['repertoire']['repertoire_id'] + ':' + str(unit['load_set_start']) + '-' + str(unit['load_set_end'])
+
+# Add work units to the queue, returns the number added. Each unit is
+# added and queued in one script, so a unit cannot be left unqueued.
+def enqueueUnits(queue, units):
+    added = 0
+    for unit in units:
+        added += queue['enqueue'](keys=[ queueKey(queue, 'units'), queueKey(queue, 'pending') ], args=[ unitId(unit), json.dumps(unit) ])
+    return added
+
+# Claim the next unit, returns (unit id, unit, attempt) or None if nothing
+# is pending, where attempt counts from 1
+def claimUnit(queue, worker, timeout):
+    result = queue['claim'](keys=[ queueKey(queue, 'pending'), queueKey(queue, 'leases'), queueKey(queue, 'owners'), queueKey(queue, 'units'),
+                                   queueKey(queue, 'attempts') ],
+                            args=[ worker, timeout ])
+    if not result:
+        return None
+    return result[0], json.loads(result[1]), int(result[2] or 0) + 1
+
+# Returns False if the worker no longer holds the lease
+def extendLease(queue, uid, worker, timeout):
+    return queue['extend'](keys=[ queueKey(queue, 'leases'), queueKey(queue, 'owners') ], args=[ uid, worker, timeout ]) == 1
+
+def completeUnit(queue, uid, worker, result):
+    return queue['complete'](keys=[ queueKey(queue, 'leases'), queueKey(queue, 'owners'), queueKey(queue, 'done') ],
+                             args=[ uid, worker, json.dumps(result) ]) == 1
+
+# Put the unit back on the queue, or in failed after max_attempts,
+# returns the number of attempts or 0 if the worker lost the lease
+def failUnit(queue, uid, worker, error, max_attempts=3):
+    return queue['fail'](keys=[ queueKey(queue, 'leases'), queueKey(queue, 'owners'), queueKey(queue, 'pending'),
+                                queueKey(queue, 'attempts'), queueKey(queue, 'failed') ],
+                         args=[ uid, worker, error, max_attempts ])
+
+def queueStatus(queue):
+    client = queue['client']
+    return {
+        "units": client.hlen(queueKey(queue, 'units')),
+        "pending": client.llen(queueKey(queue, 'pending')),
+        "claimed": client.zcard(queueKey(queue, 'leases')),
+        "done": client.hlen(queueKey(queue, 'done')),
+        "failed": client.hlen(queueKey(queue, 'failed'))
+    }
+
+# Queue the failed units again with their attempts reset
+def requeueFailed(queue):
+    client = queue['client']
+    failed = client.hkeys(queueKey(queue, 'failed'))
+    for uid in failed:
+        client.hdel(queueKey(queue, 'failed'), uid)
+        client.hdel(queueKey(queue, 'attempts'), uid)
+        client.rpush(queueKey(queue, 'pending'), uid)
+    return len(failed)
+
+def resetQueue(queue):
+    client = queue['client']
+    for key in [ 'units', 'pending', 'leases', 'owners', 'attempts', 'done', 'failed' ]:
+        client.delete(queueKey(queue, key))
+
+# Work units of a load plan with everything a worker needs to load them
+def planUnits(plan, repertoire_file=None, file_prefix=None):
+    data = airr.read_airr(repertoire_file or plan['repertoire_file'])
+    reps = { rep['repertoire_id']: rep for rep in data['Repertoire'] }
+    units = []
+    for u in plan['work_units']:
+        units.append({
+            "repertoire": reps[u['repertoire_id']],
+            "file_prefix": file_prefix or plan['file_prefix'],
+            "load_set_size": plan['load_set_size'],
+            "load_set_start": u['load_set_start'],
+            "load_set_end": u['load_set_end'],
+            "rows": u['rows']
+        })
+    return units
+
+def printQueueStatus(queue):
+    status = queueStatus(queue)
+    rows = 0
+    for value in queue['client'].hvals(queueKey(queue, 'done')):
+        rows += json.loads(value).get('inserted', 0)
+    print('Queue ' + queue['name'] + ': ' + str(status['units']) + ' units, ' + str(status['pending']) + ' pending, '
+          + str(status['claimed']) + ' claimed, ' + str(status['done']) + ' done, ' + str(status['failed']) + ' failed')
+    print('Records inserted by completed units: ' + str(rows))
+    for uid, error in queue['client'].hgetall(queueKey(queue, 'failed')).items():
+        print('FAILED: ' + uid + ': ' + error)
+
+# main entry
+if (__name__=="__main__"):
+    parser = argparse.ArgumentParser(description='Coordinate a rearrangement load over a Redis work queue.')
+    parser.add_argument('command', type=str, choices=[ 'enqueue', 'status', 'requeue-failed', 'reset' ], help='Queue command')
+    parser.add_argument('plan_file', type=str, nargs='?', help='Load plan from load_plan.py, for enqueue')
+    parser.add_argument('--queue-url', type=str, default=default_queue_url, help='Redis URL (default: ADC_LOAD_QUEUE_URL or redis://localhost:6379/0)')
+    parser.add_argument('--queue-name', type=str, default='rearrangement', help='Queue name (default: rearrangement)')
+    parser.add_argument('--repertoire-file', type=str, help='Repertoire file instead of the one in the plan')
+    parser.add_argument('--file-prefix', type=str, help='File prefix for the workers instead of the one in the plan')
+    args = parser.parse_args()
+
+    if args:
+        if redis is None:
+            print('ERROR: the redis module is needed for the load queue')
+            sys.exit(1)
+        queue = openLoadQueue(args.queue_url, args.queue_name)
+        if args.command == 'enqueue':
+            if not args.plan_file:
+                print('ERROR: enqueue needs a plan file')
+                sys.exit(1)
+            units = planUnits(readLoadPlan(args.plan_file), args.repertoire_file, args.file_prefix)
+            print('Enqueued ' + str(enqueueUnits(queue, units)) + ' of ' + str(len(units)) + ' work units')
+        elif args.command == 'requeue-failed':
+            print('Requeued ' + str(requeueFailed(queue)) + ' failed work units')
+        elif args.command == 'reset':
+            resetQueue(queue)
+            print('Removed queue: ' + args.queue_name)
+        printQueueStatus(queue)
@@ -5,46 +5,13 @@
 #
 
 import json
-from dotenv import load_dotenv
-import os
 import airr
 import yaml
 import requests
+import sys
 import argparse
-
-# Setup
-def getConfig():
-    if load_dotenv(dotenv_path='/api-js-tapis/.env'):
-        cfg = {}
-        cfg['api_server'] = os.getenv('WSO2_HOST')
-        cfg['api_key'] = os.getenv('WSO2_CLIENT_KEY')
-        cfg['api_secret'] = os.getenv('WSO2_CLIENT_SECRET')
-        cfg['username'] = os.getenv('VDJ_SERVICE_ACCOUNT')
-        cfg['password'] = os.getenv('VDJ_SERVICE_ACCOUNT_SECRET')
-        cfg['dbname'] = os.getenv('MONGODB_DB')
-        return cfg
-    else:
-        print('ERROR: loading config')
-        return None
-
-# Fetches a user token based on the supplied auth object
-# and returns the auth object with token data on success
-def getToken(config):
-    data = {
-        "grant_type":"password",
-        "scope":"PRODUCTION",
-        "username":config['username'],
-        "password":config['password']
-    }
-    headers = {
-        "Content-Type":"application/x-www-form-urlencoded"
-    }
-
-    url = 'https://' + config['api_server'] + '/token'
-
-    resp = requests.post(url, data=data, headers=headers, auth=(config['api_key'], config['api_secret']))
-    token = resp.json()
-    return token
+from adc_client import apiConfig, apiURL, getToken, getSession
+from load_plan import readLoadPlan, planRepertoire, loadSetRows
 
 # count number of rearrangements for repertoire
 def countRearrangements(token, config, collection, repertoire_id, load_set):
@@ -59,9 +26,9 @@ def countRearrangements(token, config, collection, repertoire_id, load_set):
     field = '$repertoire_id'
     avars = { "match": query, "field": field }
     avars = requests.utils.quote(json.dumps(avars))
-    url = 'https://' + config['api_server'] + '/meta/v3/' + config['dbname'] + '/' + collection + '/_aggrs/' + 'facets?avars=' + avars
+    url = apiURL(config) + '/meta/v3/' + config['dbname'] + '/' + collection + '/_aggrs/' + 'facets?avars=' + avars
     print(url)
-    resp = requests.get(url, headers=headers)
+    resp = getSession(config).get(url, headers=headers)
 
     result = resp.json()
     #print(result)
@@ -70,19 +37,118 @@ def countRearrangements(token, config, collection, repertoire_id, load_set):
     else:
         return result[0]['count']
 
+# count rearrangements in every load set of the repertoire with one facets query,
+# returns a dictionary of load set to count
+def countLoadSets(token, config, collection, repertoire_id):
+    headers = {
+        "Content-Type":"application/json",
+        "Accept": "application/json",
+        "Authorization": "Bearer " + token['access_token']
+    }
+
+    query = { "repertoire_id": repertoire_id }
+    avars = { "match": query, "field": '$vdjserver_load_set' }
+    avars = requests.utils.quote(json.dumps(avars))
+    url = apiURL(config) + '/meta/v3/' + config['dbname'] + '/' + collection + '/_aggrs/' + 'facets?avars=' + avars
+    resp = getSession(config).get(url, headers=headers)
+    if not resp.ok:
+        raise RuntimeError('facets query failed (' + str(resp.status_code) + '): ' + resp.text)
+    return { r['_id']: r['count'] for r in resp.json() }
+
+# Rows in each load set of the repertoire from the load plan
+def expectedLoadSets(plan, repertoire_id):
+    entry = planRepertoire(plan, repertoire_id)
+    if entry is None:
+        return None
+    return loadSetRows(entry['files'], plan['load_set_size'])
+
+# Compare the load set counts with the expected rows of each load set,
+# returns a list of (load_set, count, expected, problem). Without the
+# expected rows, only missing load sets and load sets with more than
+# load_set_size rearrangements can be found, and without load_set_end
+# the load sets are checked up to the last one in the counts.
+def verifyLoadSets(counts, load_set_size, load_set_start=0, load_set_end=None, expected=None):
+    if load_set_end is None:
+        if expected is not None:
+            load_set_end = len(expected)
+        else:
+            load_set_end = max([ k for k in counts if isinstance(k, int) ], default=load_set_start - 1) + 1
+    problems = []
+    for load_set in range(load_set_start, load_set_end):
+        count = counts.get(load_set, 0)
+        rows = None
+        if expected is not None and load_set < len(expected):
+            rows = expected[load_set]
+        if count == 0:
+            problems.append((load_set, count, rows, 'missing'))
+        elif count > load_set_size or (rows is not None and count > rows):
+            problems.append((load_set, count, rows, 'duplicated'))
+        elif rows is not None and count < rows:
+            problems.append((load_set, count, rows, 'short'))
+    # rearrangements in load sets the plan does not have
+    if expected is not None:
+        for load_set, count in counts.items():
+            if not isinstance(load_set, int) or load_set < 0 or load_set >= len(expected):
+                problems.append((load_set, count, None, 'unexpected'))
+    return problems
+
+def printLoadSetHistogram(counts, expected=None):
+    print('load_set\tcount\texpected')
+    for load_set in sorted(counts, key=lambda k: (not isinstance(k, int), k if isinstance(k, int) else 0, str(k))):
+        rows = ''
+        if expected is not None and isinstance(load_set, int) and 0 <= load_set < len(expected):
+            rows = str(expected[load_set])
+        print(str(load_set) + '\t' + str(counts[load_set]) + '\t' + rows)
+
+def printLoadSetProblems(repertoire_id, counts, problems):
+    for load_set, count, rows, problem in problems:
+        print('ERROR: repertoire ' + repertoire_id + ' load set ' + str(load_set) + ' is ' + problem + ': count ' + str(count)
+              + ('' if rows is None else ', expected ' + str(rows)))
+    print('Repertoire ' + repertoire_id + ': ' + str(len(counts)) + ' load sets, ' + str(sum(counts.values())) + ' rearrangements, '
+          + str(len(problems)) + ' problems')
+
 # main entry
 if (__name__=="__main__"):
     parser = argparse.ArgumentParser(description='Count rearrangements for load set for repertoire metadata.')
     parser.add_argument('collection', type=str, help='Rearrangement collection')
     parser.add_argument('repertoire_id', type=str, help='Repertoire identifier')
-    parser.add_argument('load_set_start', type=int, help='Load set start')
-    parser.add_argument('load_set_end', type=int, help='Load set end')
+    parser.add_argument('load_set_start', type=int, nargs='?', default=0, help='Load set start')
+    parser.add_argument('load_set_end', type=int, nargs='?', help='Load set end')
+    parser.add_argument('--verify', action='store_true', help='Count all load sets with one query grouped by load set, and report missing, short and duplicated load sets')
+    parser.add_argument('--plan', type=str, help='Load plan from load_plan.py with the expected rows of each load set, for --verify')
+    parser.add_argument('--load-set-size', type=int, default=1000, help='Rows per load set, for --verify without --plan (default: 1000)')
+    parser.add_argument('--histogram', action='store_true', help='Print the count of every load set for --verify')
+    parser.add_argument('--api-url', type=str, help='Base URL of the API server instead of the .env file')
     args = parser.parse_args()
 
     if args:
-        config = getConfig()
+        config = apiConfig(args.api_url)
+        if config is None:
+            sys.exit(1)
         token = getToken(config)
 
+        if args.verify:
+            expected = None
+            load_set_size = args.load_set_size
+            if args.plan:
+                plan = readLoadPlan(args.plan)
+                load_set_size = plan['load_set_size']
+                expected = expectedLoadSets(plan, args.repertoire_id)
+                if expected is None:
+                    print('ERROR: plan does not have repertoire: ' + args.repertoire_id)
+                    sys.exit(1)
+            counts = countLoadSets(token, config, args.collection, args.repertoire_id)
+            if args.histogram:
+                printLoadSetHistogram(counts, expected)
+            problems = verifyLoadSets(counts, load_set_size, args.load_set_start, args.load_set_end, expected)
+            printLoadSetProblems(args.repertoire_id, counts, problems)
+            if len(problems) > 0:
+                sys.exit(1)
+            sys.exit(0)
+
+        if args.load_set_end is None:
+            parser.error('load_set_end is required without --verify')
+
         for load_set in range(args.load_set_start,args.load_set_end):
             total = 0
             result = countRearrangements(token, config, args.collection, args.repertoire_id, load_set)
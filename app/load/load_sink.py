@@ -0,0 +1,104 @@
+#
+# Local sinks for the rearrangement loader, to measure the read, transform
+# and encode stages without sending anything to the server.
+#
+#   jsonl  each insert request body is written as a line to <dir>/<repertoire_id>.jsonl
+#   bson   each record is written as a BSON document to <dir>/<repertoire_id>.bson,
+#          in the same format as mongodump so it can be loaded with mongorestore
+#   null   each insert request body is encoded, and compressed if configured,
+#          then discarded
+#
+# The sink counts the records and bytes it was given. Files are written
+# by one thread at a time, the upload workers can share a sink.
+#
+
+import os
+import threading
+from adc_client import encodeJSON, compressBody, streamJSON, compressStream
+
+# BSON encoding comes with pymongo
+try:
+    import bson
+except ImportError:
+    bson = None
+
+sink_kinds = [ 'jsonl', 'bson', 'null' ]
+
+def openLoadSink(kind, path='.'):
+    if kind == 'bson' and bson is None:
+        raise RuntimeError('bson sink requires the pymongo module')
+    if kind != 'null':
+        os.makedirs(path, exist_ok=True)
+    return { "kind": kind, "path": path, "lock": threading.Lock(), "files": {}, "records": 0, "bytes": 0 }
+
+def closeLoadSink(sink):
+    with sink['lock']:
+        for f in sink['files'].values():
+            f.close()
+        sink['files'] = {}
+
+def sinkFilename(sink, repertoire_id):
+    return os.path.join(sink['path'], repertoire_id + '.' + sink['kind'])
+
+# Start writing a repertoire, the file is truncated unless
+# appending to it, such as when reloading some of the load sets
+def sinkRepertoire(sink, repertoire_id, append=False):
+    if sink['kind'] == 'null':
+        return
+    with sink['lock']:
+        f = sink['files'].pop(repertoire_id, None)
+        if f:
+            f.close()
+        sink['files'][repertoire_id] = open(sinkFilename(sink, repertoire_id), 'ab' if append else 'wb')
+
+# Write the records of an insert request, returns the number of records
+def sinkInsert(sink, config, records):
+    if len(records) == 0:
+        return 0
+    repertoire_id = records[0]['repertoire_id']
+    if config.get('stream_body') and sink['kind'] != 'bson':
+        return sinkStream(sink, config, repertoire_id, records)
+    if sink['kind'] == 'bson':
+        body = b''.join([ bson.encode(r) for r in records ])
+    else:
+        body = encodeJSON(records, config.get('json_encoder', 'auto'))
+        if sink['kind'] == 'null':
+            body, encoding = compressBody(body, config.get('compression', 'none'), config.get('compression_level', 1))
+        else:
+            body += b'\n'
+
+    with sink['lock']:
+        if sink['kind'] != 'null':
+            if repertoire_id not in sink['files']:
+                sink['files'][repertoire_id] = open(sinkFilename(sink, repertoire_id), 'ab')
+            sink['files'][repertoire_id].write(body)
+        sink['records'] += len(records)
+        sink['bytes'] += len(body)
+    return len(records)
+
+# Same as sinkInsert() but with the streaming encoder, the file
+# lock is held while the chunks are written so lines are not mixed
+def sinkStream(sink, config, repertoire_id, records):
+    chunks = streamJSON(records, config.get('json_encoder', 'auto'))
+    if sink['kind'] == 'null':
+        chunks, encoding = compressStream(chunks, config.get('compression', 'none'), config.get('compression_level', 1))
+        nbytes = sum(len(chunk) for chunk in chunks)
+        with sink['lock']:
+            sink['records'] += len(records)
+            sink['bytes'] += nbytes
+        return len(records)
+
+    with sink['lock']:
+        if repertoire_id not in sink['files']:
+            sink['files'][repertoire_id] = open(sinkFilename(sink, repertoire_id), 'ab')
+        f = sink['files'][repertoire_id]
+        for chunk in chunks:
+            f.write(chunk)
+            sink['bytes'] += len(chunk)
+        f.write(b'\n')
+        sink['records'] += len(records)
+        sink['bytes'] += 1
+    return len(records)
+
+def printSinkStats(sink):
+    print('Sink ' + sink['kind'] + ': ' + str(sink['records']) + ' records, ' + str(sink['bytes']) + ' bytes')
@@ -0,0 +1,74 @@
+#
+# Facet statistics for a repertoire, counted while the rearrangements are
+# loaded. The statistics document has the same counts as a facets query on
+# the rearrangement collection for a single repertoire, so the common
+# facets can be answered without grouping over every rearrangement.
+#
+#   {
+#     "statistics_type": "facets",
+#     "repertoire_id": "...",
+#     "data_processing_id": "...",
+#     "total": 12345,
+#     "facets": {
+#       "v_call": [ { "_id": "TRBV29-1*01", "count": 17 }, ... ],
+#       ...
+#     },
+#     "updated": "2020-01-01T00:00:00Z"
+#   }
+#
+# Like $group, a missing field is counted under null, and a field with
+# several values, such as an ambiguous gene call, is counted as the array.
+#
+# junction_aa is not a facet here, it is nearly unique for each row so its
+# counts would be about as large as the repertoire and a large repertoire
+# would pass the 16MB limit on a document. junction_aa_length is counted.
+#
+# The documents are kept in their own collection, not the statistics
+# collection that the API uses for its statistics cache, and are only
+# replaced by statistics_type and repertoire_id.
+#
+
+import time
+
+default_statistics_collection = 'facet_statistics'
+statistics_type = 'facets'
+
+facet_fields = [ 'v_call', 'v_gene', 'v_subgroup',
+                 'd_call', 'd_gene', 'd_subgroup',
+                 'j_call', 'j_gene', 'j_subgroup',
+                 'junction_aa_length', 'productive', 'locus' ]
+
+def newFacetTally():
+    return { "total": 0, "facets": { field: {} for field in facet_fields } }
+
+# Count the facet values of transformed records
+def tallyRecords(tally, records):
+    facets = tally['facets']
+    for r in records:
+        for field in facet_fields:
+            value = r.get(field)
+            if isinstance(value, list):
+                value = tuple(value)
+            counts = facets[field]
+            counts[value] = counts.get(value, 0) + 1
+    tally['total'] += len(records)
+
+# Sort key for the facet values, numbers such as junction_aa_length
+# sort numerically and before strings, with null last
+def facetOrder(v):
+    number = isinstance(v, (int, float))
+    return (v is None, not number, v if number else str(v))
+
+def statisticsDocument(tally, repertoire_id, data_processing_id):
+    facets = {}
+    for field, counts in tally['facets'].items():
+        values = sorted(counts, key=facetOrder)
+        facets[field] = [ { "_id": list(v) if isinstance(v, tuple) else v, "count": counts[v] } for v in values ]
+    return {
+        "statistics_type": statistics_type,
+        "repertoire_id": repertoire_id,
+        "data_processing_id": data_processing_id,
+        "total": tally['total'],
+        "facets": facets,
+        "updated": time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+    }
@@ -0,0 +1,249 @@
+#
+# Small local stand-in for the Tapis token and Meta V3 (RestHeart) end
+# points used by the loader, for benchmarks and testing without a network.
+#
+#   POST /token                                  returns a token
+#   POST /meta/v3/<db>/<collection>/             inserts an array of documents
+#   DELETE /meta/v3/<db>/<collection>/*?filter=  deletes matching documents
+#   GET /meta/v3/<db>/<collection>?filter=&keys=&page=&pagesize=  matching
+#        documents, a page at a time
+#   GET /meta/v3/<db>/<collection>/_aggrs/facets?avars=  counts matching
+#        documents grouped by a field, like the facets aggregation
+#
+# Request bodies can be gzip or zstd compressed, and chunked. Each request can be given
+# a latency and a chance of failing with an error status. By default only
+# repertoire_id, vdjserver_load_set and receptor_id are kept for each
+# document, --store-documents keeps the whole document. Request statistics
+# are printed when the server is stopped.
+#
+# This does not need the docker container or a .env file.
+#
+
+import json
+import argparse
+import gzip
+import random
+import threading
+import time
+import urllib.parse
+import http.server
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+key_fields = [ 'repertoire_id', 'vdjserver_load_set', 'receptor_id' ]
+
+class MockState:
+    def __init__(self, args):
+        self.args = args
+        self.lock = threading.Lock()
+        self.collections = {}
+        self.stats = { "requests": 0, "inserts": 0, "documents": 0, "bytes": 0, "errors": 0, "deletes": 0, "queries": 0 }
+        self.start = time.time()
+
+    def collection(self, db, name):
+        return self.collections.setdefault((db, name), [])
+
+# Simple matching for the filters the loader scripts use, equality and $in
+def matchDocument(doc, query):
+    for k, v in query.items():
+        if isinstance(v, dict) and '$in' in v:
+            if doc.get(k) not in v['$in']:
+                return False
+        elif doc.get(k) != v:
+            return False
+    return True
+
+class MockHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        if self.server.state.args.verbose:
+            http.server.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def sendJSON(self, status, obj):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # streamed bodies are sent with chunked transfer encoding
+    def readChunked(self):
+        chunks = []
+        while True:
+            size = int(self.rfile.readline().split(b';')[0].strip(), 16)
+            if size == 0:
+                while self.rfile.readline() not in (b'\r\n', b'\n', b''):
+                    pass
+                break
+            chunks.append(self.rfile.read(size))
+            self.rfile.readline()
+        return b''.join(chunks)
+
+    def readBody(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            body = self.readChunked()
+        else:
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.body_bytes = len(body)
+        encoding = self.headers.get('Content-Encoding')
+        if encoding == 'gzip':
+            body = gzip.decompress(body)
+        elif encoding == 'zstd':
+            if zstandard is None:
+                return None
+            body = zstandard.ZstdDecompressor().decompress(body, max_output_size=1 << 31)
+        return body
+
+    # Simulated latency and errors, returns True if the request should fail
+    def simulate(self):
+        state = self.server.state
+        with state.lock:
+            state.stats['requests'] += 1
+        if state.args.latency > 0 or state.args.jitter > 0:
+            time.sleep(max(0.0, state.args.latency + random.uniform(-state.args.jitter, state.args.jitter)))
+        if state.args.error_rate > 0 and random.random() < state.args.error_rate:
+            with state.lock:
+                state.stats['errors'] += 1
+            return True
+        return False
+
+    def metaPath(self):
+        url = urllib.parse.urlparse(self.path)
+        parts = url.path.strip('/').split('/')
+        if len(parts) < 4 or parts[0] != 'meta' or parts[1] != 'v3':
+            return None, None, None, urllib.parse.parse_qs(url.query)
+        return parts[2], parts[3], parts[4:], urllib.parse.parse_qs(url.query)
+
+    def do_POST(self):
+        state = self.server.state
+        if self.path.startswith('/token'):
+            self.readBody()
+            self.sendJSON(200, { "access_token": "mock-token", "expires_in": state.args.token_expires, "token_type": "bearer" })
+            return
+
+        db, name, rest, query = self.metaPath()
+        if db is None:
+            self.sendJSON(404, { "message": "not found" })
+            return
+        body = self.readBody()
+        nbytes = self.body_bytes
+        if body is None:
+            self.sendJSON(415, { "message": "unsupported Content-Encoding" })
+            return
+        if self.simulate():
+            self.sendJSON(state.args.error_status, { "message": "injected error" })
+            return
+        docs = json.loads(body)
+        if isinstance(docs, dict):
+            docs = [ docs ]
+        if not state.args.store_documents:
+            docs = [ { k: d.get(k) for k in key_fields } for d in docs ]
+        with state.lock:
+            state.collection(db, name).extend(docs)
+            state.stats['inserts'] += 1
+            state.stats['documents'] += len(docs)
+            state.stats['bytes'] += nbytes
+        self.sendJSON(200, { "inserted": len(docs), "deleted": 0, "modified": 0, "matched": 0 })
+
+    def do_DELETE(self):
+        state = self.server.state
+        db, name, rest, query = self.metaPath()
+        if db is None:
+            self.sendJSON(404, { "message": "not found" })
+            return
+        if self.simulate():
+            self.sendJSON(state.args.error_status, { "message": "injected error" })
+            return
+        match = json.loads(query.get('filter', ['{}'])[0])
+        with state.lock:
+            docs = state.collection(db, name)
+            keep = [ d for d in docs if not matchDocument(d, match) ]
+            deleted = len(docs) - len(keep)
+            state.collections[(db, name)] = keep
+            state.stats['deletes'] += 1
+        self.sendJSON(200, { "inserted": 0, "deleted": deleted, "modified": 0, "matched": deleted })
+
+    def do_GET(self):
+        state = self.server.state
+        db, name, rest, query = self.metaPath()
+        if db is None:
+            self.sendJSON(404, { "message": "not found" })
+            return
+        if self.simulate():
+            self.sendJSON(state.args.error_status, { "message": "injected error" })
+            return
+        with state.lock:
+            state.stats['queries'] += 1
+            docs = list(state.collection(db, name))
+
+        if rest == []:
+            match = json.loads(query.get('filter', ['{}'])[0])
+            keys = json.loads(query.get('keys', ['{}'])[0])
+            page = int(query.get('page', ['1'])[0])
+            pagesize = int(query.get('pagesize', ['100'])[0])
+            docs = [ d for d in docs if matchDocument(d, match) ][(page - 1) * pagesize:page * pagesize]
+            if keys:
+                docs = [ { k: d[k] for k in keys if k in d } for d in docs ]
+            self.sendJSON(200, docs)
+            return
+
+        if rest == [ '_aggrs', 'facets' ]:
+            avars = json.loads(query.get('avars', ['{}'])[0])
+            match = avars.get('match', {})
+            field = avars.get('field', '$repertoire_id').lstrip('$')
+            counts = {}
+            for d in docs:
+                if matchDocument(d, match):
+                    counts[d.get(field)] = counts.get(d.get(field), 0) + 1
+            result = [ { "_id": k, "count": counts[k] } for k in sorted(counts, key=lambda x: (x is None, str(x))) ]
+            self.sendJSON(200, result)
+            return
+
+        self.sendJSON(404, { "message": "not found" })
+
+def printStats(state):
+    elapsed = time.time() - state.start
+    stats = state.stats
+    print('Requests: ' + str(stats['requests']) + ', errors injected: ' + str(stats['errors']))
+    print('Inserts: ' + str(stats['inserts']) + ', documents: ' + str(stats['documents']) + ', bytes received: ' + str(stats['bytes']))
+    print('Deletes: ' + str(stats['deletes']) + ', queries: ' + str(stats['queries']))
+    if elapsed > 0:
+        print('{:.1f}'.format(stats['documents'] / elapsed) + ' documents/sec over ' + '{:.1f}'.format(elapsed) + ' secs')
+
+def startServer(args):
+    server = http.server.ThreadingHTTPServer((args.host, args.port), MockHandler)
+    server.daemon_threads = True
+    server.state = MockState(args)
+    return server
+
+# main entry
+if (__name__=="__main__"):
+    parser = argparse.ArgumentParser(description='Mock token and Meta V3 end points for loader benchmarks.')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Address to listen on (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8080, help='Port to listen on (default: 8080)')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds of latency for each request (default: 0)')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Random seconds added to or removed from the latency (default: 0)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of requests that fail (default: 0)')
+    parser.add_argument('--error-status', type=int, default=504, help='Status code of failed requests (default: 504)')
+    parser.add_argument('--token-expires', type=int, default=14400, help='Token expires_in seconds (default: 14400)')
+    parser.add_argument('--store-documents', action='store_true', help='Keep whole documents instead of just the key fields')
+    parser.add_argument('--seed', type=int, help='Random seed for repeatable latency and errors')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Log each request')
+    args = parser.parse_args()
+
+    if args:
+        if args.seed is not None:
+            random.seed(args.seed)
+        server = startServer(args)
+        print('Mock Meta V3 listening on http://' + args.host + ':' + str(args.port))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        server.server_close()
+        printStats(server.state)
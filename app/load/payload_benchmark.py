@@ -0,0 +1,70 @@
+#
+# Micro-benchmark of the insert payload encoding for rearrangement_load.py.
+#
+# Rows from AIRR TSV files are transformed into load sets as the loader
+# would, then each combination of JSON encoder and compression is timed
+# for serializing and compressing every load set, and the bytes that
+# would be sent on the wire are reported. Encoders and compression that
+# are not installed fall back like they do in the loader, and are skipped.
+#
+
+import argparse
+import time
+import airr
+from adc_client import jsonEncoder, encodeJSON, compressBody, zstandard
+from rearrangement_load import transformLoadSet
+
+def readLoadSets(filename, limit, load_set_size):
+    load_sets = []
+    records = []
+    cnt = 0
+    reader = airr.read_rearrangement(filename)
+    for r in reader:
+        records.append(r)
+        cnt += 1
+        if len(records) == load_set_size:
+            load_sets.append(transformLoadSet(records, 'payload-benchmark', 'payload-benchmark', len(load_sets)))
+            records = []
+        if limit and cnt >= limit:
+            break
+    if len(records) > 0:
+        load_sets.append(transformLoadSet(records, 'payload-benchmark', 'payload-benchmark', len(load_sets)))
+    return load_sets, cnt
+
+def benchmark(load_sets, encoder, compression, level):
+    t = time.time()
+    wire_bytes = 0
+    json_bytes = 0
+    for records in load_sets:
+        body = encodeJSON(records, encoder)
+        json_bytes += len(body)
+        body, encoding = compressBody(body, compression, level)
+        wire_bytes += len(body)
+    return time.time() - t, json_bytes, wire_bytes
+
+# main entry
+if (__name__=="__main__"):
+    parser = argparse.ArgumentParser(description='Benchmark serialize and compress of rearrangement insert payloads.')
+    parser.add_argument('airr_files', type=str, nargs='+', help='AIRR rearrangement TSV files')
+    parser.add_argument('--limit', type=int, default=100000, help='Maximum number of rows per file (default: 100000)')
+    parser.add_argument('--load-set-size', type=int, default=1000, help='Rows per load set (default: 1000)')
+    args = parser.parse_args()
+
+    if args:
+        encoders = []
+        for name in [ 'orjson', 'ujson', 'json' ]:
+            if jsonEncoder(name) == name:
+                encoders.append(name)
+        compressions = [ ('none', 0), ('gzip', 1), ('gzip', 6) ]
+        if zstandard is not None:
+            compressions.extend([ ('zstd', 1), ('zstd', 3) ])
+
+        print('file\trows\tencoder\tcompression\tlevel\tsecs\trows/sec\tjson_bytes\twire_bytes\tratio')
+        for filename in args.airr_files:
+            load_sets, cnt = readLoadSets(filename, args.limit, args.load_set_size)
+            for encoder in encoders:
+                for compression, level in compressions:
+                    secs, json_bytes, wire_bytes = benchmark(load_sets, encoder, compression, level)
+                    print(filename + '\t' + str(cnt) + '\t' + encoder + '\t' + compression + '\t' + str(level)
+                          + '\t' + '{:.3f}'.format(secs) + '\t' + '{:.1f}'.format(cnt / secs if secs > 0 else 0)
+                          + '\t' + str(json_bytes) + '\t' + str(wire_bytes) + '\t' + '{:.3f}'.format(wire_bytes / json_bytes))
@@ -0,0 +1,86 @@
+#
+# Benchmark and check the fast TSV reader against the airr reader.
+#
+# Each AIRR TSV file is read with airr.read_rearrangement and with the
+# FastRearrangementReader used by rearrangement_load.py --fast-reader,
+# and the rows/sec of each is reported. With --validate, every row from
+# the fast reader is compared with the airr reader, including the types
+# of the values, and the first differences are printed.
+#
+
+import sys
+import argparse
+import itertools
+import math
+import time
+import airr
+from rearrangement_files import openRearrangementReader
+
+def readRows(filename, fast, limit):
+    t = time.time()
+    cnt = 0
+    reader = openRearrangementReader(filename, 0, fast)
+    for r in reader:
+        cnt += 1
+        if limit and cnt >= limit:
+            break
+    return cnt, time.time() - t
+
+# NaN is not equal to itself, and True == 1 so compare types too
+def sameValue(a, b):
+    if type(a) != type(b):
+        return False
+    if isinstance(a, float) and math.isnan(a):
+        return math.isnan(b)
+    return a == b
+
+def validate(filename, limit, max_errors=10):
+    errors = 0
+    cnt = 0
+    expected = airr.read_rearrangement(filename)
+    actual = openRearrangementReader(filename, 0, True)
+    for a, b in itertools.zip_longest(expected, actual):
+        cnt += 1
+        # both readers should run out of rows at the same time
+        if a is None or b is None:
+            print('number of rows differ')
+            errors += 1
+            break
+        if list(a.keys()) != list(b.keys()):
+            print('row ' + str(cnt) + ': fields differ')
+            errors += 1
+        for k in a:
+            if not sameValue(a[k], b.get(k)):
+                print('row ' + str(cnt) + ': ' + k + ' airr=' + repr(a[k]) + ' fast=' + repr(b.get(k)))
+                errors += 1
+        if errors >= max_errors or (limit and cnt >= limit):
+            break
+    return cnt, errors
+
+# main entry
+if (__name__=="__main__"):
+    parser = argparse.ArgumentParser(description='Benchmark and validate the fast AIRR TSV reader.')
+    parser.add_argument('airr_files', type=str, nargs='+', help='AIRR rearrangement TSV files')
+    parser.add_argument('--limit', type=int, default=0, help='Maximum number of rows per file (default: all)')
+    parser.add_argument('--validate', action='store_true', help='Compare every row with the airr reader')
+    args = parser.parse_args()
+
+    if args:
+        failed = False
+        print('file\trows\tairr_secs\tairr_rows/sec\tfast_secs\tfast_rows/sec\tspeedup')
+        for filename in args.airr_files:
+            cnt, airr_secs = readRows(filename, False, args.limit)
+            cnt, fast_secs = readRows(filename, True, args.limit)
+            print(filename + '\t' + str(cnt) + '\t' + '{:.2f}'.format(airr_secs) + '\t' + '{:.1f}'.format(cnt / airr_secs if airr_secs > 0 else 0)
+                  + '\t' + '{:.2f}'.format(fast_secs) + '\t' + '{:.1f}'.format(cnt / fast_secs if fast_secs > 0 else 0)
+                  + '\t' + '{:.2f}'.format(airr_secs / fast_secs if fast_secs > 0 else 0))
+        if args.validate:
+            for filename in args.airr_files:
+                cnt, errors = validate(filename, args.limit)
+                if errors > 0:
+                    print('ERROR: ' + filename + ' has differences in the first ' + str(cnt) + ' rows')
+                    failed = True
+                else:
+                    print(filename + ': ' + str(cnt) + ' rows identical')
+        if failed:
+            sys.exit(1)
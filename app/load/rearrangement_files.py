@@ -0,0 +1,410 @@
+#
+# Locating, indexing and opening the AIRR rearrangement files for a
+# repertoire. This assumes you are running in the docker container.
+#
+# A load set index is a sidecar file (<file>.loadsets.json) that records
+# the byte offset where each load set of load_set_size rows begins. For
+# gzip files the offsets are in the decompressed stream. The loader uses
+# the index to seek straight to a load set instead of parsing the rows
+# before it. The index is rebuilt if the file or load set size changes.
+#
+# Compressed files (.gz, including bgzf, and .zst) are decompressed by a
+# pigz or zstd subprocess if one is installed, so decompression runs on
+# other cores while the rows are parsed, otherwise in this process with
+# the gzip or zstandard module. Offsets are always in the decompressed
+# stream, so seeking reads and discards the bytes before the offset.
+#
+# Rows are counted in large blocks of bytes, from a memory map for an
+# uncompressed file or directly from the decompressed stream, and only
+# the blocks with quotes are split to skip newlines in quoted fields.
+#
+# Run as a script to pre-scan the files and build the indexes.
+#
+
+import json
+import os
+import sys
+import io
+import re
+import gzip
+import mmap
+import itertools
+import shutil
+import subprocess
+import argparse
+import concurrent.futures
+import airr
+from rearrangement_reader import FastRearrangementReader, read_buffer_size
+
+# optional zstd decompression in process
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# threads for pigz, zstd decompression is single threaded but
+# still runs in its own process
+decompress_threads = int(os.getenv('ADC_LOAD_DECOMPRESS_THREADS', '4'))
+# set ADC_LOAD_DECOMPRESS_PROCESS=false to always decompress in process
+decompress_process = os.getenv('ADC_LOAD_DECOMPRESS_PROCESS', 'true') == 'true'
+
+# Get the primary data processing for the repertoire
+def getPrimaryDataProcessing(rep):
+    primary_dp = None
+    for dp in rep['data_processing']:
+        if dp.get('primary_annotation'):
+            primary_dp = dp
+    if not primary_dp:
+        print('ERROR: Repertoire missing primary data processing: ' + rep['repertoire_id'])
+        sys.exit(1)
+    return primary_dp
+
+# Locate the rearrangement file, either directly under the prefix
+# or in a subdirectory named by the data_processing_id. A compressed
+# file can also be found as an uncompressed copy.
+def findRearrangementFile(file_prefix, primary_dp, f):
+    names = [ f ]
+    for ext in [ '.gz', '.zst' ]:
+        if f.endswith(ext):
+            names.append(f[:-len(ext)])
+    for name in names:
+        if os.path.isfile(file_prefix + '/' + name):
+            return file_prefix + '/' + name
+        elif os.path.isfile(file_prefix + '/' + primary_dp['data_processing_id'] + '/' + name):
+            return file_prefix + '/' + primary_dp['data_processing_id'] + '/' + name
+    print('ERROR: cannot find file: ' + f)
+    sys.exit(1)
+
+# Rearrangement files of the repertoire
+def repertoireFiles(rep, file_prefix):
+    primary_dp = getPrimaryDataProcessing(rep)
+    return [ findRearrangementFile(file_prefix, primary_dp, f) for f in primary_dp['data_processing_files'] ]
+
+# Raw stream from the stdout of a decompression process, closing
+# it stops the process if it has not finished. At the end of the
+# stream the process must have succeeded, so a truncated or corrupt
+# file raises an error like the gzip module does, instead of ending early.
+class ProcessReader(io.RawIOBase):
+    def __init__(self, args):
+        self.process = subprocess.Popen(args, stdout=subprocess.PIPE, bufsize=0)
+        self.failed = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        n = self.process.stdout.readinto(buffer)
+        if n == 0 and self.process.wait() != 0:
+            self.failed = True
+            raise EOFError(self.process.args[0] + ' exited with ' + str(self.process.returncode) + ' reading: ' + self.process.args[-1])
+        return n
+
+    def close(self):
+        if not self.closed:
+            self.process.stdout.close()
+            if self.process.poll() is None:
+                self.process.terminate()
+            self.process.wait()
+            # stopped by the terminate or the closed pipe when it was not read to the end
+            if self.process.returncode not in (0, -13, -15) and not self.failed:
+                print('WARNING: ' + self.process.args[0] + ' exited with ' + str(self.process.returncode))
+        io.RawIOBase.close(self)
+
+def decompressCommand(filename):
+    if not decompress_process:
+        return None
+    if filename.endswith('.gz') and shutil.which('pigz'):
+        return [ 'pigz', '-d', '-c', '-p', str(decompress_threads), filename ]
+    if filename.endswith('.zst') and shutil.which('zstd'):
+        return [ 'zstd', '-d', '-c', '-q', filename ]
+    return None
+
+# Open the file as a binary stream of the decompressed data
+def openBinary(filename):
+    command = decompressCommand(filename)
+    if command:
+        return io.BufferedReader(ProcessReader(command), buffer_size=read_buffer_size)
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'rb')
+    if filename.endswith('.zst'):
+        if zstandard is None:
+            print('ERROR: zstd or the zstandard module is needed to read: ' + filename)
+            sys.exit(1)
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(filename, 'rb'), read_size=read_buffer_size), buffer_size=read_buffer_size)
+    return open(filename, 'rb', buffering=read_buffer_size)
+
+def isCompressed(filename):
+    return filename.endswith('.gz') or filename.endswith('.zst')
+
+# Move forward to the offset from the current position, by seeking if the
+# stream can, otherwise by reading and discarding the bytes in between
+def seekForward(handle, position, offset):
+    if handle.seekable():
+        handle.seek(offset)
+        return
+    remaining = offset - position
+    while remaining > 0:
+        data = handle.read(min(remaining, read_buffer_size))
+        if not data:
+            break
+        remaining -= len(data)
+
+# a quote that starts a field, at the start of the text or after a tab
+# or newline, any other quote is part of the field like the csv reader
+_field_quote = re.compile(rb'(?<![^\t\n])"')
+
+# Spans of the text from i that are outside of quoted fields, as a list
+# of (start, end), and whether the text ends inside a quoted field. Like
+# the csv excel-tab dialect, only a quote at the start of a field begins
+# a quoted field, and in one "" is a quote and a single quote ends it.
+def _unquotedSpans(text, i=0, in_quote=False):
+    spans = []
+    n = len(text)
+    while i < n:
+        if in_quote:
+            j = text.find(b'"', i)
+            if j < 0:
+                return spans, True
+            if text[j + 1:j + 2] == b'"':
+                i = j + 2
+                continue
+            in_quote = False
+            i = j + 1
+        else:
+            m = _field_quote.search(text, i)
+            if m is None:
+                spans.append((i, n))
+                return spans, False
+            spans.append((i, m.start()))
+            in_quote = True
+            i = m.start() + 1
+    return spans, in_quote
+
+# Scan the file for the byte offset of the first row of each load set.
+# Quoted fields can contain newlines, so a row only ends at a newline
+# outside of quotes. Blank lines are skipped like the csv reader does.
+def scanLoadSets(filename, load_set_size):
+    handle = openBinary(filename)
+    offsets = []
+    rows = 0
+    in_quote = False
+    try:
+        header = handle.readline()
+        offset = len(header)
+        for line in handle:
+            if not in_quote:
+                if line == b'\n' or line == b'\r\n':
+                    offset += len(line)
+                    continue
+                if rows % load_set_size == 0:
+                    offsets.append(offset)
+                rows += 1
+            if b'"' in line:
+                in_quote = _unquotedSpans(line, 0, in_quote)[1]
+            offset += len(line)
+    finally:
+        handle.close()
+
+    stat = os.stat(filename)
+    return {
+        "file": os.path.basename(filename),
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "load_set_size": load_set_size,
+        "rows": rows,
+        "offsets": offsets
+    }
+
+# count rows in blocks of this many bytes
+count_block_size = 1 << 24
+
+# a newline that ends a blank line
+_blank_line = re.compile(rb'\n(?=\r?\n)')
+
+# Blank lines in text outside of quotes, tail is the text just before it
+# to find blank lines that start in the previous block
+def _blankLines(text, tail):
+    blank = len(_blank_line.findall(text))
+    if tail:
+        edge = tail + text[:2]
+        for i in range(len(tail)):
+            if _blank_line.match(edge, i) and not _blank_line.match(tail, i):
+                blank += 1
+    return blank
+
+# Count the rows of the file without the header, the same rows as
+# scanLoadSets: a row only ends at a newline outside of quotes, and
+# blank lines are skipped. An up to date load set index has the rows
+# already, unless use_index is False.
+def countRows(filename, block_size=count_block_size, use_index=True):
+    if use_index:
+        index = readLoadSetIndex(filename)
+        if index is not None:
+            return index['rows']
+    if isCompressed(filename):
+        handle = openBinary(filename)
+    else:
+        if os.path.getsize(filename) == 0:
+            return 0
+        with open(filename, 'rb') as f:
+            handle = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    lines = 0
+    blank = 0
+    in_quote = False
+    last = b''
+    try:
+        header = handle.readline()
+        tail = header[-2:]
+        prev = header[-1:]
+        while True:
+            block = handle.read(block_size)
+            if not block:
+                break
+            # a quote at the end of the block could be the first of ""
+            while block.endswith(b'"'):
+                more = handle.read(1)
+                if not more:
+                    break
+                block += more
+            if not in_quote and b'"' not in block:
+                lines += block.count(b'\n')
+                blank += _blankLines(block, tail)
+                tail = (tail + block[-2:])[-2:]
+                prev = last = block[-1:]
+                continue
+            # the byte before the block tells if the block starts a field
+            text = prev + block
+            spans, in_quote = _unquotedSpans(text, 1, in_quote)
+            for start, end in spans:
+                piece = text[start:end]
+                piece_tail = tail if start == 1 else b''
+                lines += piece.count(b'\n')
+                blank += _blankLines(piece, piece_tail)
+                tail = (piece_tail + piece)[-2:]
+            if not spans or spans[-1][1] != len(text):
+                tail = b''
+            prev = last = block[-1:]
+    finally:
+        handle.close()
+    # the last row might not end with a newline
+    if in_quote or (last and last != b'\n'):
+        lines += 1
+    return lines - blank
+
+# Count the rows of the files in a process pool, returns a dictionary of filename to rows
+def countRowsInFiles(filenames, processes=1, use_index=True):
+    counts = {}
+    if processes > 1 and len(filenames) > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as pool:
+            for filename, rows in zip(filenames, pool.map(countRows, filenames, [ count_block_size ] * len(filenames), [ use_index ] * len(filenames))):
+                counts[filename] = rows
+    else:
+        for filename in filenames:
+            counts[filename] = countRows(filename, use_index=use_index)
+    return counts
+
+# Count the rows of all of the files of the repertoires at once
+def countRepertoireFiles(reps, file_prefix, processes=1, use_index=True):
+    filenames = []
+    for rep in reps:
+        for filename in repertoireFiles(rep, file_prefix):
+            if filename not in filenames:
+                filenames.append(filename)
+    return countRowsInFiles(filenames, processes, use_index)
+
+def loadSetIndexFilename(filename):
+    return filename + '.loadsets.json'
+
+# Read the load set index for the file, returns None if there is
+# no index or it is out of date, or for another load set size if given
+def readLoadSetIndex(filename, load_set_size=None):
+    index_file = loadSetIndexFilename(filename)
+    if not os.path.isfile(index_file):
+        return None
+    try:
+        index = json.load(open(index_file, 'r'))
+    except ValueError:
+        return None
+    stat = os.stat(filename)
+    if index.get('size') != stat.st_size or index.get('mtime') != stat.st_mtime:
+        return None
+    if load_set_size is not None and index.get('load_set_size') != load_set_size:
+        return None
+    return index
+
+def writeLoadSetIndex(filename, index):
+    try:
+        with open(loadSetIndexFilename(filename), 'w') as writer:
+            json.dump(index, writer)
+    except OSError as e:
+        print('WARNING: cannot write load set index for ' + filename + ': ' + str(e))
+
+# Get the load set index for the file, building it if needed
+def getLoadSetIndex(filename, load_set_size):
+    index = readLoadSetIndex(filename, load_set_size)
+    if index is None:
+        print('Building load set index: ' + filename)
+        index = scanLoadSets(filename, load_set_size)
+        writeLoadSetIndex(filename, index)
+    return index
+
+# Lines of a text stream after the header line that was read from it,
+# closing them closes the stream
+class HeaderLines:
+    def __init__(self, header, handle):
+        self.handle = handle
+        self.lines = itertools.chain([header], handle)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.lines)
+
+    def close(self):
+        self.handle.close()
+
+# Open an AIRR rearrangement reader starting at the byte offset
+# of a row, the header is read first to get the field names.
+def openRearrangementReader(filename, offset=0, fast=False):
+    if offset == 0:
+        if isCompressed(filename):
+            # text mode like airr.read_rearrangement
+            handle = io.TextIOWrapper(openBinary(filename), encoding='utf-8')
+            if fast:
+                return FastRearrangementReader(handle)
+            return airr.io.RearrangementReader(handle)
+        if not fast:
+            return airr.read_rearrangement(filename)
+        return FastRearrangementReader(open(filename, 'r', buffering=read_buffer_size))
+    handle = openBinary(filename)
+    header = handle.readline()
+    seekForward(handle, len(header), offset)
+    header = header.decode('utf-8')
+    lines = io.TextIOWrapper(handle, encoding='utf-8', newline='')
+    if fast:
+        return FastRearrangementReader(HeaderLines(header, lines))
+    return airr.io.RearrangementReader(HeaderLines(header, lines))
+
+# main entry
+if (__name__=="__main__"):
+    parser = argparse.ArgumentParser(description='Build load set indexes for the AIRR rearrangement files of repertoires.')
+    parser.add_argument('repertoire_file', type=str, help='AIRR repertoire metadata file name')
+    parser.add_argument('file_prefix', type=str, help='Directory prefix to find the rearrangements files')
+    parser.add_argument('--load-set-size', type=int, default=1000, help='Rows per load set (default: 1000)')
+    parser.add_argument('--force', action='store_true', help='Rebuild indexes that are up to date')
+    args = parser.parse_args()
+
+    if args:
+        data = airr.load_repertoire(args.repertoire_file)
+        for rep in data['Repertoire']:
+            primary_dp = getPrimaryDataProcessing(rep)
+            for f in primary_dp['data_processing_files']:
+                filename = findRearrangementFile(args.file_prefix, primary_dp, f)
+                index = None
+                if not args.force:
+                    index = readLoadSetIndex(filename, args.load_set_size)
+                if index is None:
+                    index = scanLoadSets(filename, args.load_set_size)
+                    writeLoadSetIndex(filename, index)
+                print(rep['repertoire_id'] + '\t' + filename + '\t' + str(index['rows']) + ' rows\t' + str(len(index['offsets'])) + ' load sets')
@@ -11,68 +11,85 @@
 #
 
 import json
-from dotenv import load_dotenv
+import hashlib
+import resource
 import os
 import sys
 import airr
 import yaml
 import requests
 import argparse
+import collections
+import concurrent.futures
+import multiprocessing
+import queue
+import socket
+import threading
+import time
+from adc_client import getConfig, offlineConfig, apiURL, setAPIURL, getToken, getSession, postJSON, setRequestLimit, requestSlot, json_encoders, compressions
+from load_journal import openLoadJournal, closeLoadJournal, journalStarted, journalInserted, journalDigest, journalLoadSets, journalCompleted, journalIncomplete, journalReset
+from load_sink import openLoadSink, closeLoadSink, sinkRepertoire, sinkInsert, printSinkStats, sink_kinds, bson
+from load_mongo import openMongoBackend, closeMongoBackend, mongoInsert, mongoDelete, pymongo
+from load_statistics import newFacetTally, tallyRecords, statisticsDocument, statistics_type, default_statistics_collection
+from load_plan import readLoadPlan, planRows
+from load_queue import openLoadQueue, claimUnit, extendLease, completeUnit, failUnit, queueStatus, default_queue_url, redis
+from rearrangement_files import getPrimaryDataProcessing, findRearrangementFile, getLoadSetIndex, openRearrangementReader
 
-# Setup
-def getConfig():
-    if load_dotenv(dotenv_path='/api-js-tapis/.env'):
-        cfg = {}
-        cfg['api_server'] = os.getenv('WSO2_HOST')
-        cfg['api_key'] = os.getenv('WSO2_CLIENT_KEY')
-        cfg['api_secret'] = os.getenv('WSO2_CLIENT_SECRET')
-        cfg['username'] = os.getenv('VDJ_SERVICE_ACCOUNT')
-        cfg['password'] = os.getenv('VDJ_SERVICE_ACCOUNT_SECRET')
-        cfg['dbname'] = os.getenv('MONGODB_DB')
-        return cfg
-    else:
-        print('ERROR: loading config')
-        return None
+# Delete all rearrangements for the repertoire_id
+def deleteRearrangements(token, config, repertoire_id, collection='rearrangement'):
+    if config.get('mongo'):
+        print('Deleted records: ' + str(mongoDelete(config['mongo'], { "repertoire_id": repertoire_id }, collection)))
+        return
+
+    # token is cached and refreshed before it expires
+    token = getToken(config)
 
-# Fetches a user token based on the supplied auth object
-# and returns the auth object with token data on success
-def getToken(config):
-    data = {
-        "grant_type":"password",
-        "scope":"PRODUCTION",
-        "username":config['username'],
-        "password":config['password']
-    }
     headers = {
-        "Content-Type":"application/x-www-form-urlencoded"
+        "Content-Type":"application/json",
+        "Accept": "application/json",
+        "Authorization": "Bearer " + token['access_token']
     }
 
-    url = 'https://' + config['api_server'] + '/token'
+    url = apiURL(config) + '/meta/v3/' + config['dbname'] + '/' + collection + '/*?filter=' + requests.utils.quote('{"repertoire_id":"' + repertoire_id + '"}')
+    print(url)
+    with requestSlot():
+        resp = getSession(config).delete(url, headers=headers)
+    print(resp.json())
 
-    resp = requests.post(url, data=data, headers=headers, auth=(config['api_key'], config['api_secret']))
-    token = resp.json()
-    return token
+# Delete all rearrangements from a load set for the repertoire_id, returns False if the delete failed
+def deleteLoadSet(token, config, repertoire_id, load_set, collection='rearrangement'):
+    if config.get('mongo'):
+        print('Deleted records: ' + str(mongoDelete(config['mongo'], { "repertoire_id": repertoire_id, "vdjserver_load_set": load_set }, collection)))
+        return True
+
+    # token is cached and refreshed before it expires
+    token = getToken(config)
 
-# Delete all rearrangements from a load set for the repertoire_id
-def deleteLoadSet(token, config, repertoire_id, load_set):
     headers = {
         "Content-Type":"application/json",
         "Accept": "application/json",
         "Authorization": "Bearer " + token['access_token']
     }
 
-    # delete rearrangements for given repertoire_id
-    if load_set == 0:
-        url = 'https://' + config['api_server'] + '/meta/v3/' + config['dbname'] + '/rearrangement/*?filter=' + requests.utils.quote('{"repertoire_id":"' + repertoire_id + '"}')
-    else:
-        url = 'https://' + config['api_server'] + '/meta/v3/' + config['dbname'] + '/rearrangement/*?filter=' + requests.utils.quote('{"repertoire_id":"' + repertoire_id + '","vdjserver_load_set":' + str(load_set) + '}')
+    url = apiURL(config) + '/meta/v3/' + config['dbname'] + '/' + collection + '/*?filter=' + requests.utils.quote('{"repertoire_id":"' + repertoire_id + '","vdjserver_load_set":' + str(load_set) + '}')
     print(url)
-    resp = requests.delete(url, headers=headers)
+    with requestSlot():
+        resp = getSession(config).delete(url, headers=headers)
     print(resp.json())
+    return resp.ok
 
 # Insert the rearrangements for a repertoire
-def insertRearrangement(token, config, records):
-    # get a token each time, in case it expired
+def insertRearrangement(token, config, records, collection='rearrangement'):
+    # offline load into a local sink
+    if config.get('sink'):
+        return sinkInsert(config['sink'], config, records)
+    # direct to the database
+    if config.get('mongo'):
+        inserted = mongoInsert(config['mongo'], records, collection)
+        print("Inserted records: " + str(inserted))
+        return inserted
+
+    # token is cached and refreshed before it expires
     token = getToken(config)
 
     headers = {
@@ -82,14 +99,16 @@ def insertRearrangement(token, config, records):
     }
 
     # insert the rearrangement
-    url = 'https://' + config['api_server'] + '/meta/v3/' + config['dbname'] + '/rearrangement/'
+    url = apiURL(config) + '/meta/v3/' + config['dbname'] + '/' + collection + '/'
     #data = [ record ]
-    resp = requests.post(url, json=records, headers=headers)
+    resp = postJSON(config, url, records, headers)
     data = resp.json()
     if data.get('inserted'):
         print("Inserted records: " + str(data['inserted']))
+        return data['inserted']
     else:
         print(resp.json())
+        return 0
 
     # pull out mongo id and make it the rearrangement_id
     #newdoc = resp.json()
@@ -103,15 +122,73 @@ def insertRearrangement(token, config, records):
     #print(resp.status_code)
     #print(resp.text)
     #print(resp.json())
-    
 
-def getAllSubstrings(str, size=4):
+
+def getAllSubstrings(str, size=4, max_size=None):
     result = []
     for i in range(0, len(str)):
-        for j in range(len(str), i+size-1, -1):
+        end = len(str)
+        if max_size is not None:
+            end = min(end, i + max_size)
+        for j in range(end, i+size-1, -1):
             result.append(str[i:j])
     return result
 
+def getAllSuffixes(str, size=4):
+    result = []
+    for i in range(0, len(str)-size+1):
+        result.append(str[i:])
+    return result
+
+# How junction_aa is expanded for substring searches
+#   all: every substring of length 4 or more in vdjserver_junction_substrings
+#   max: substrings of length 4 up to junction_max_length in vdjserver_junction_substrings
+#   suffix: every suffix of length 4 or more in vdjserver_junction_suffixes
+#   none: no expansion
+junction_modes = [ 'all', 'max', 'suffix', 'none' ]
+
+default_transform_options = {
+    "junction_mode": "all",
+    "junction_max_length": None,
+    "prune": "none",
+    "keep_fields": ()
+}
+
+# Pruning of empty fields, the API fills in missing AIRR fields
+# as null when it returns rearrangements
+#   none: send every column
+#   null: remove fields that are None, such as empty numbers and booleans
+#   empty: also remove empty strings
+prune_modes = [ 'none', 'null', 'empty' ]
+prune_stats = { "fields": 0, "bytes": 0 }
+
+# Remove the empty fields, returns the number of fields and the JSON bytes
+# they would have taken, "key":null, or "key":"",
+def pruneRearrangement(r, prune, keep_fields=()):
+    if prune == 'empty':
+        empty = [ k for k, v in r.items() if (v is None or v == '') and k not in keep_fields ]
+    else:
+        empty = [ k for k, v in r.items() if v is None and k not in keep_fields ]
+    saved = 0
+    for k in empty:
+        saved += len(k) + (8 if r[k] is None else 6)
+        del r[k]
+    return len(empty), saved
+
+def addJunctionSubstrings(r, options):
+    mode = options['junction_mode']
+    if mode == 'none':
+        return
+    junction_aa = r.get('junction_aa')
+    if junction_aa is None or len(junction_aa) <= 3:
+        return
+    if mode == 'suffix':
+        r['vdjserver_junction_suffixes'] = getAllSuffixes(junction_aa, 4)
+    elif mode == 'max':
+        r['vdjserver_junction_substrings'] = getAllSubstrings(junction_aa, 4, options['junction_max_length'])
+    else:
+        r['vdjserver_junction_substrings'] = getAllSubstrings(junction_aa, 4)
+
 def parseGene(str):
     result = { "gene": None, "subgroup": None }
     aidx = str.find('*')
@@ -124,119 +201,958 @@ def parseGene(str):
         result['subgroup'] = result['gene'][0:didx]
     return result
 
-def changeGeneCall(name, name_gene, name_subgroup, obj):
-    fields = obj[name].split(',')
+# Cache of resolved gene calls keyed by the raw call string. The number of
+# distinct calls is small (a few hundred alleles plus ambiguous combinations)
+# so once full, new calls are resolved but no longer cached.
+gene_call_cache = {}
+gene_call_cache_size = 100000
+gene_call_stats = { "hits": 0, "misses": 0 }
+
+# Resolve a raw call string into (calls, genes, subgroups). For comma
+# separated ambiguous calls these are tuples, one entry per allele.
+def resolveGeneCall(value):
+    entry = gene_call_cache.get(value)
+    if entry is not None:
+        gene_call_stats['hits'] += 1
+        return entry
+    gene_call_stats['misses'] += 1
+
+    fields = value.split(',')
     if len(fields) > 1:
-        obj[name] = fields
         genes = []
         subgroups = []
-        for i in range(0, len(fields)):
-            c = fields[i]
-            result = parseGene(c);
-            if result == None:
+        for c in fields:
+            result = parseGene(c)
+            if result is None:
                 genes.append(None)
                 subgroups.append(None)
             else:
                 genes.append(result['gene'])
                 subgroups.append(result['subgroup'])
-            obj[name_gene] = genes;
-            obj[name_subgroup] = subgroups;
+        entry = (tuple(fields), tuple(genes), tuple(subgroups))
     else:
-        result = parseGene(obj[name])
+        result = parseGene(value)
         if result:
-            obj[name_gene] = result['gene']
-            if result['subgroup']:
-                obj[name_subgroup] = result['subgroup']
+            entry = (value, result['gene'], result['subgroup'])
+        else:
+            entry = (value, None, None)
+
+    if len(gene_call_cache) < gene_call_cache_size:
+        gene_call_cache[value] = entry
+    return entry
+
+# Preload the gene call cache from a germline allele list, either an
+# IMGT germline FASTA (allele name is the second | separated header field)
+# or a plain text file with one allele name per line.
+def preloadGeneCalls(filename):
+    cnt = 0
+    with open(filename, 'r') as reader:
+        for line in reader:
+            line = line.strip()
+            if len(line) == 0:
+                continue
+            if line[0] == '>':
+                fields = line[1:].split('|')
+                if len(fields) > 1:
+                    allele = fields[1].strip()
+                else:
+                    allele = fields[0].split()[0]
+            elif line[0] in 'ACGTNacgtn.-':
+                # sequence line
+                continue
+            else:
+                allele = line
+            if allele not in gene_call_cache and len(gene_call_cache) < gene_call_cache_size:
+                resolveGeneCall(allele)
+                gene_call_stats['misses'] -= 1
+                cnt += 1
+    print('Preloaded ' + str(cnt) + ' germline alleles into gene call cache')
+
+def changeGeneCall(name, name_gene, name_subgroup, obj):
+    calls, gene, subgroup = resolveGeneCall(obj[name])
+    if isinstance(calls, tuple):
+        # copy so records do not share the cached entries
+        obj[name] = list(calls)
+        obj[name_gene] = list(gene)
+        obj[name_subgroup] = list(subgroup)
+    elif gene is not None:
+        obj[name_gene] = gene
+        if subgroup:
+            obj[name_subgroup] = subgroup
+
+# Convert an AIRR rearrangement row into the document stored in the repository
+def transformRearrangement(r, repertoire_id, data_processing_id, load_set, options=default_transform_options):
+    if r.get('repertoire_id') is None:
+        r['repertoire_id'] = repertoire_id
+    if len(r['repertoire_id']) == 0:
+        r['repertoire_id'] = repertoire_id
+    if r.get('data_processing_id') is None:
+        r['data_processing_id'] = data_processing_id
+    if len(r['data_processing_id']) == 0:
+        r['data_processing_id'] = data_processing_id
+    r['vdjserver_load_set'] = load_set
+
+    r['receptor_id'] = r['sequence_id']
+    del r['sequence_id']
+
+    changeGeneCall('v_call', 'v_gene', 'v_subgroup', r)
+    changeGeneCall('d_call', 'd_gene', 'd_subgroup', r)
+    changeGeneCall('j_call', 'j_gene', 'j_subgroup', r)
+
+    addJunctionSubstrings(r, options)
+    return r
+
+# Transform all the rows of a load set, this is the unit of work
+# sent to the transform processes so it must be a top-level function
+def transformLoadSet(records, repertoire_id, data_processing_id, load_set, options=default_transform_options):
+    for r in records:
+        transformRearrangement(r, repertoire_id, data_processing_id, load_set, options)
+    prune = options.get('prune', 'none')
+    if prune != 'none':
+        fields = 0
+        saved = 0
+        for r in records:
+            f, b = pruneRearrangement(r, prune, options.get('keep_fields', ()))
+            fields += f
+            saved += b
+        prune_stats['fields'] += fields
+        prune_stats['bytes'] += saved
+        print('Pruned load set ' + str(load_set) + ': ' + str(fields) + ' empty fields, ' + str(saved) + ' bytes')
+    return records
+
+# Process pool entry point, also returns the gene call cache hits and
+# misses and the pruned fields and bytes for this load set so the parent
+# can report the overall hit rate and savings
+def transformLoadSetInProcess(records, repertoire_id, data_processing_id, load_set, options):
+    hits = gene_call_stats['hits']
+    misses = gene_call_stats['misses']
+    fields = prune_stats['fields']
+    saved = prune_stats['bytes']
+    records = transformLoadSet(records, repertoire_id, data_processing_id, load_set, options)
+    return records, gene_call_stats['hits'] - hits, gene_call_stats['misses'] - misses, prune_stats['fields'] - fields, prune_stats['bytes'] - saved
+
+# Wait for a load set from the transform processes
+def transformResult(future):
+    records, hits, misses, fields, saved = future.result()
+    gene_call_stats['hits'] += hits
+    gene_call_stats['misses'] += misses
+    prune_stats['fields'] += fields
+    prune_stats['bytes'] += saved
+    return records
+
+# Throughput counters for the read/transform and upload stages
+def newLoadStats():
+    return {
+        "lock": threading.Lock(),
+        "start": time.time(),
+        "read_records": 0,
+        "read_time": 0.0,
+        "upload_records": 0,
+        "upload_sets": 0,
+        "upload_time": 0.0,
+        "upload_requests": 0,
+        "upload_errors": 0,
+        "unchanged_sets": 0,
+        "planned_records": 0
+    }
+
+# Progress against the planned rows, the rate and estimated
+# time left are from the records read and transformed so far
+def printProgress(stats):
+    elapsed = time.time() - stats['start']
+    done = stats['read_records']
+    planned = stats['planned_records']
+    if elapsed <= 0 or done == 0:
+        return
+    rate = done / elapsed
+    eta = max(0, planned - done) / rate
+    print('Progress: ' + str(done) + ' of ' + str(planned) + ' records (' + '{:.1f}'.format(100.0 * done / planned) + '%), '
+          + '{:.1f}'.format(rate) + ' records/sec, ETA ' + '{:.0f}'.format(eta) + ' secs')
+
+def printLoadStats(stats):
+    elapsed = time.time() - stats['start']
+    print('Elapsed time: ' + '{:.1f}'.format(elapsed) + ' secs')
+    if stats['read_time'] > 0:
+        print('Read/transform stage: ' + str(stats['read_records']) + ' records, '
+              + '{:.1f}'.format(stats['read_records'] / stats['read_time']) + ' records/sec')
+    if stats['upload_time'] > 0:
+        # upload time is summed over workers, so divide by elapsed for the aggregate rate
+        print('Upload stage: ' + str(stats['upload_records']) + ' records in ' + str(stats['upload_sets']) + ' load sets, '
+              + '{:.1f}'.format(stats['upload_records'] / stats['upload_time']) + ' records/sec per worker, '
+              + '{:.1f}'.format(stats['upload_records'] / elapsed) + ' records/sec overall')
+    if stats['upload_requests'] > stats['upload_sets']:
+        print('Insert requests: ' + str(stats['upload_requests']) + ', '
+              + '{:.1f}'.format(stats['upload_records'] / stats['upload_requests']) + ' records/request')
+    if stats['unchanged_sets'] > 0:
+        print('Unchanged load sets skipped: ' + str(stats['unchanged_sets']))
+    lookups = gene_call_stats['hits'] + gene_call_stats['misses']
+    if lookups > 0:
+        print('Gene call cache: ' + str(gene_call_stats['hits']) + ' hits, ' + str(gene_call_stats['misses']) + ' misses, '
+              + '{:.1f}'.format(100.0 * gene_call_stats['hits'] / lookups) + '% hit rate')
+    # ru_maxrss is in kilobytes on Linux
+    print('Peak memory: ' + '{:.1f}'.format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024) + ' MB')
+    if prune_stats['fields'] > 0:
+        print('Pruned empty fields: ' + str(prune_stats['fields']) + ', ' + str(prune_stats['bytes']) + ' bytes saved')
+    if stats['upload_errors'] > 0:
+        print('ERROR: ' + str(stats['upload_errors']) + ' load sets failed to upload')
+
+# Read the rearrangement files for a repertoire, yielding (load_set, rows)
+# of untransformed rows. Load sets are numbered sequentially across all of the files.
+# With use_index, the load set index of each file is used to skip files and
+# seek directly to the first load set from load_set_start that is not in
+# skip_load_sets, and reading stops at load_set_end.
+def readRawLoadSets(primary_dp, file_prefix, load_set_size, load_set_start=0, load_set_end=None, use_index=False, skip_load_sets=None, fast_reader=False):
+    load_set = 0
+    files = primary_dp['data_processing_files']
+    for f in files:
+        filename = findRearrangementFile(file_prefix, primary_dp, f)
+        if load_set_end is not None and load_set >= load_set_end:
+            break
+
+        offset = 0
+        if use_index:
+            index = getLoadSetIndex(filename, load_set_size)
+            file_load_sets = len(index['offsets'])
+            first = load_set + file_load_sets
+            for ls in range(max(load_set, load_set_start), load_set + file_load_sets):
+                if load_set_end is not None and ls >= load_set_end:
+                    break
+                if skip_load_sets is None or ls not in skip_load_sets:
+                    first = ls
+                    break
+            if first == load_set + file_load_sets:
+                print('Skipping load sets ' + str(load_set) + ' to ' + str(first - 1) + ' in file: ' + filename)
+                load_set = first
+                continue
+            if first > load_set:
+                print('Skipping load sets ' + str(load_set) + ' to ' + str(first - 1) + ' in file: ' + filename)
+                offset = index['offsets'][first - load_set]
+                load_set = first
+
+        print('AIRR rearrangement file: ' + filename)
+        reader = openRearrangementReader(filename, offset, fast_reader)
+
+        total = 0
+        records = []
+        try:
+            for r in reader:
+                records.append(r)
+                total += 1
+                if len(records) == load_set_size:
+                    yield load_set, records
+                    load_set += 1
+                    records = []
+                    if load_set_end is not None and load_set >= load_set_end:
+                        break
+        finally:
+            reader.close()
+        if len(records) != 0:
+            yield load_set, records
+            load_set += 1
+        print('Total records read from file: ' + str(total))
+
+# Read and transform the rearrangement files for a repertoire, yielding
+# (load_set, records) for each load set from load_set_start up to load_set_end.
+# With transform_processes, load sets are transformed in a process pool
+# with a bounded number in flight, and are still yielded in load set order.
+def generateLoadSets(rep, primary_dp, file_prefix, load_set_size, load_set_start, stats, transform_processes=0, options=default_transform_options, load_set_end=None, use_index=False, skip_load_sets=None, fast_reader=False):
+    repertoire_id = rep['repertoire_id']
+    data_processing_id = primary_dp['data_processing_id']
+    raw_load_sets = readRawLoadSets(primary_dp, file_prefix, load_set_size, load_set_start, load_set_end, use_index, skip_load_sets, fast_reader)
+
+    if transform_processes > 0:
+        pool = concurrent.futures.ProcessPoolExecutor(max_workers=transform_processes)
+    else:
+        pool = None
+    pending = collections.deque()
+    try:
+        t = time.time()
+        for load_set, records in raw_load_sets:
+            if load_set < load_set_start:
+                print('Skipping load set: ' + str(load_set))
+                continue
+            if skip_load_sets is not None and load_set in skip_load_sets:
+                print('Skipping load set already loaded: ' + str(load_set))
+                continue
+            if pool is None:
+                records = transformLoadSet(records, repertoire_id, data_processing_id, load_set, options)
+                stats['read_time'] += time.time() - t
+                stats['read_records'] += len(records)
+                yield load_set, records
+                t = time.time()
+                continue
+
+            pending.append((load_set, pool.submit(transformLoadSetInProcess, records, repertoire_id, data_processing_id, load_set, options)))
+            if len(pending) >= 2 * transform_processes:
+                load_set, future = pending.popleft()
+                records = transformResult(future)
+                stats['read_time'] += time.time() - t
+                stats['read_records'] += len(records)
+                yield load_set, records
+                t = time.time()
+        while pending:
+            load_set, future = pending.popleft()
+            records = transformResult(future)
+            stats['read_time'] += time.time() - t
+            stats['read_records'] += len(records)
+            yield load_set, records
+            t = time.time()
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+
+# Adaptive sizing of insert requests. Load sets keep their fixed number of
+# rows, but a load set can be sent in several requests. The records per
+# request grows additively while requests are under the target latency,
+# and is halved when a request fails or is too slow (AIMD). It is also
+# capped so the estimated payload stays under the target bytes.
+def newBatchControl(min_batch, max_batch, target_bytes, target_latency):
+    return {
+        "lock": threading.Lock(),
+        "min_batch": min_batch,
+        "max_batch": max_batch,
+        "target_bytes": target_bytes,
+        "target_latency": target_latency,
+        "increase": max(1, max_batch // 20),
+        "batch": max_batch
+    }
+
+# Estimate the JSON size of a record from a sample of the records
+def estimateRecordBytes(records):
+    step = max(1, len(records) // 20)
+    sample = records[::step]
+    return max(1, len(json.dumps(sample)) // len(sample))
+
+def nextBatchSize(control, record_bytes):
+    with control['lock']:
+        batch = control['batch']
+    batch = min(batch, control['target_bytes'] // record_bytes)
+    return max(control['min_batch'], batch)
+
+def batchFeedback(control, latency, ok):
+    with control['lock']:
+        if ok and latency <= control['target_latency']:
+            control['batch'] = min(control['max_batch'], control['batch'] + control['increase'])
+        else:
+            control['batch'] = max(control['min_batch'], control['batch'] // 2)
+
+# Digest of the transformed records of a load set, so the digest changes
+# if either the rows or the transform options change. The standard
+# library encoder is used so the digest does not depend on what is installed.
+def digestLoadSet(records):
+    body = json.dumps(records, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(body.encode('utf-8')).hexdigest()
+
+# Record the digest of each load set in the journal before it is uploaded.
+# For an incremental reload, only pass on the load sets whose digest
+# differs from the one in the journal, deleting the old load set first.
+# Load sets past the end of the files are deleted once they are all read.
+# The digest is only computed for --incremental, other loads clear it so
+# a later incremental reload replaces those load sets.
+def digestLoadSets(token, config, repertoire_id, load_sets, journal, stats, incremental=False):
+    previous = {}
+    if incremental:
+        previous = journalLoadSets(journal, repertoire_id)
+    last = -1
+    for load_set, records in load_sets:
+        last = load_set
+        digest = None
+        if incremental:
+            digest = digestLoadSet(records)
+        entry = previous.get(load_set)
+        if entry and entry[0] == 'inserted' and entry[3] == digest:
+            with stats['lock']:
+                stats['unchanged_sets'] += 1
+            continue
+        if entry:
+            print('Replacing changed load set: ' + str(load_set))
+            # the old rows would stay alongside the new ones
+            if not deleteLoadSet(token, config, repertoire_id, load_set):
+                raise RuntimeError('could not delete changed load set ' + str(load_set) + ' of repertoire ' + repertoire_id)
+        journalDigest(journal, repertoire_id, load_set, len(records), digest)
+        yield load_set, records
+
+    if not incremental:
+        return
+    for load_set in sorted(previous):
+        if load_set > last:
+            print('Deleting removed load set: ' + str(load_set))
+            if not deleteLoadSet(token, config, repertoire_id, load_set):
+                raise RuntimeError('could not delete removed load set ' + str(load_set) + ' of repertoire ' + repertoire_id)
+    journalReset(journal, repertoire_id, last + 1)
+
+# Count the facet statistics of every load set as it is read
+def tallyLoadSets(load_sets, tally):
+    for load_set, records in load_sets:
+        tallyRecords(tally, records)
+        yield load_set, records
+
+# Delete only the facet statistics documents of the repertoire, other
+# documents in the collection are left alone, returns False if the delete failed
+def deleteStatistics(token, config, repertoire_id, collection=default_statistics_collection):
+    query = { "repertoire_id": repertoire_id, "statistics_type": statistics_type }
+    if config.get('mongo'):
+        print('Deleted statistics: ' + str(mongoDelete(config['mongo'], query, collection)))
+        return True
+
+    # token is cached and refreshed before it expires
+    token = getToken(config)
+
+    headers = {
+        "Content-Type":"application/json",
+        "Accept": "application/json",
+        "Authorization": "Bearer " + token['access_token']
+    }
+
+    url = apiURL(config) + '/meta/v3/' + config['dbname'] + '/' + collection + '/*?filter=' + requests.utils.quote(json.dumps(query))
+    print(url)
+    with requestSlot():
+        resp = getSession(config).delete(url, headers=headers)
+    print(resp.json())
+    return resp.ok
+
+# Replace the statistics document for the repertoire, the sinks
+# write it to a file next to the rearrangements instead
+def writeStatistics(token, config, doc, collection=default_statistics_collection):
+    sink = config.get('sink')
+    if sink:
+        if sink['kind'] != 'null':
+            filename = os.path.join(sink['path'], doc['repertoire_id'] + '.statistics.json')
+            with open(filename, 'w') as f:
+                json.dump(doc, f, indent=2)
+            print('Wrote statistics: ' + filename)
+        return
+    # the delete and insert get a fresh token, the load may have outlived the first one
+    if not deleteStatistics(token, config, doc['repertoire_id'], collection):
+        print('ERROR: could not replace statistics for repertoire: ' + doc['repertoire_id'])
+        return
+    if insertRearrangement(token, config, [ doc ], collection) != 1:
+        print('ERROR: could not insert statistics for repertoire: ' + doc['repertoire_id'])
+
+# Insert a load set and record the upload stage timing,
+# and the acknowledged records in the journal if there is one.
+# Once abort is set, no more insert requests are sent.
+def uploadLoadSet(token, config, repertoire_id, load_set, records, stats, journal=None, control=None, abort=None):
+    if abort is not None and abort.is_set():
+        print('Aborted, not inserting load set: ' + str(load_set))
+        return
+    print('Inserting load set: ' + str(load_set))
+    if journal:
+        journalStarted(journal, repertoire_id, load_set, len(records))
+    t = time.time()
+    requests_sent = 0
+    if control is None:
+        try:
+            inserted = insertRearrangement(token, config, records)
+        except Exception as e:
+            print('ERROR: load set ' + str(load_set) + ' failed: ' + str(e))
+            inserted = 0
+        requests_sent = 1
+    else:
+        # send the load set in adaptively sized requests, stop at the
+        # first failure as the whole load set will need to be reloaded
+        inserted = 0
+        record_bytes = estimateRecordBytes(records)
+        i = 0
+        while i < len(records):
+            if abort is not None and abort.is_set():
+                print('ERROR: load set ' + str(load_set) + ' aborted')
+                break
+            n = nextBatchSize(control, record_bytes)
+            chunk = records[i:i+n]
+            ct = time.time()
+            try:
+                chunk_inserted = insertRearrangement(token, config, chunk)
+            except Exception as e:
+                print('ERROR: load set ' + str(load_set) + ' failed: ' + str(e))
+                chunk_inserted = 0
+            requests_sent += 1
+            inserted += chunk_inserted
+            batchFeedback(control, time.time() - ct, chunk_inserted == len(chunk))
+            if chunk_inserted != len(chunk):
+                break
+            i += n
+    if journal:
+        journalInserted(journal, repertoire_id, load_set, len(records), inserted)
+    with stats['lock']:
+        stats['upload_time'] += time.time() - t
+        stats['upload_sets'] += 1
+        stats['upload_requests'] += requests_sent
+        stats['upload_records'] += inserted
+        if inserted != len(records):
+            stats['upload_errors'] += 1
+        if stats['planned_records'] > 0:
+            printProgress(stats)
+
+# Upload worker, consumes load sets from the queue until it gets None
+def uploadWorker(token, config, repertoire_id, work_queue, stats, journal, control, abort=None):
+    while True:
+        item = work_queue.get()
+        if item is None:
+            work_queue.task_done()
+            return
+        # any error fails the load set but the worker keeps draining the
+        # queue, otherwise the reader would block on the full queue
+        try:
+            uploadLoadSet(token, config, repertoire_id, item[0], item[1], stats, journal, control, abort)
+        except Exception as e:
+            print('ERROR: load set ' + str(item[0]) + ' failed: ' + str(e))
+            with stats['lock']:
+                stats['upload_sets'] += 1
+                stats['upload_errors'] += 1
+        work_queue.task_done()
+
+# Load with a single reader/transform stage feeding a bounded queue
+# that is drained by parallel upload workers.
+def loadPipelined(token, config, repertoire_id, load_sets, workers, stats, journal=None, control=None, abort=None):
+    # bound the queue so the reader cannot run too far ahead of the uploads
+    work_queue = queue.Queue(maxsize=2 * workers)
+    threads = []
+    for i in range(0, workers):
+        th = threading.Thread(target=uploadWorker, args=(token, config, repertoire_id, work_queue, stats, journal, control, abort), daemon=True)
+        th.start()
+        threads.append(th)
+
+    # the workers finish the queued load sets even if reading fails
+    try:
+        for load_set, records in load_sets:
+            if abort is not None and abort.is_set():
+                break
+            work_queue.put((load_set, records))
+    finally:
+        for th in threads:
+            work_queue.put(None)
+        for th in threads:
+            th.join()
+
+# Configuration for the loader with the command line overrides
+def loadConfig(args):
+    if args.sink or args.api_url or (args.backend == 'mongo' and args.mongo_db):
+        # the .env file is optional when not loading into the repository
+        config = offlineConfig()
+        if os.path.exists('/api-js-tapis/.env'):
+            config = getConfig()
+    else:
+        config = getConfig()
+        if config is None:
+            sys.exit(1)
+    if args.api_url:
+        setAPIURL(config, args.api_url)
+    # one pooled connection per upload worker
+    config['pool_size'] = max(config['pool_size'], args.workers)
+    if args.sink:
+        config['sink'] = openLoadSink(args.sink, args.sink_path)
+    elif args.backend == 'mongo':
+        config['mongo'] = openMongoBackend(args.mongo_uri, args.mongo_db or config['dbname'], args.write_concern, args.write_journal, config['pool_size'])
+    if args.json_encoder:
+        config['json_encoder'] = args.json_encoder
+    if args.compression:
+        config['compression'] = args.compression
+    if args.stream_body:
+        config['stream_body'] = True
+    return config
+
+def transformOptions(args):
+    options = dict(default_transform_options)
+    options['junction_mode'] = args.junction_mode
+    options['junction_max_length'] = args.junction_max_length
+    options['prune'] = args.prune
+    if args.keep_fields:
+        options['keep_fields'] = tuple(args.keep_fields.split(','))
+    return options
+
+def batchControl(args):
+    if not args.adaptive_batch:
+        return None
+    max_batch = args.load_set_size
+    if args.max_batch:
+        max_batch = min(args.max_batch, args.load_set_size)
+    return newBatchControl(min(args.min_batch, max_batch), max_batch, args.target_bytes, args.target_latency)
+
+# Load the rearrangements for a repertoire, returns a summary of the load.
+# Setting abort stops the inserts and raises an error.
+def loadRepertoire(rep, args, config, options, control, journal, load_set_start=0, load_set_end=None, abort=None):
+    load_set_size = args.load_set_size
+    sink = config.get('sink')
+    token = None
+    if not sink and not config.get('mongo'):
+        token = getToken(config)
+
+    repertoire_id = rep['repertoire_id']
+    print('Loading AIRR rearrangements for repertoire: ' + repertoire_id)
+    skip_load_sets = None
+    if sink:
+        # nothing to delete, rewrite the sink file unless loading part of it
+        print('Loading into ' + sink['kind'] + ' sink')
+        sinkRepertoire(sink, repertoire_id, append=(args.resume or load_set_start > 0 or load_set_end is not None))
+        if args.resume:
+            skip_load_sets = journalCompleted(journal, repertoire_id)
+        elif journal:
+            journalReset(journal, repertoire_id, load_set_start, load_set_end)
+    elif args.incremental:
+        # compare every load set with the journal, a repertoire
+        # without any journal entries is loaded from scratch
+        if len(journalLoadSets(journal, repertoire_id)) == 0:
+            print('No load sets in the journal, loading all of them')
+            deleteRearrangements(token, config, repertoire_id)
+        else:
+            print('Incremental reload, only replacing changed load sets')
+    elif args.resume:
+        # reload the load sets that did not finish, skip the ones that did
+        skip_load_sets = journalCompleted(journal, repertoire_id)
+        print('Resuming, ' + str(len(skip_load_sets)) + ' load sets already loaded')
+        for load_set in sorted(journalIncomplete(journal, repertoire_id)):
+            if load_set >= load_set_start and (load_set_end is None or load_set < load_set_end):
+                print('Deleting incomplete load set: ' + str(load_set))
+                # loading it again over the partial insert would duplicate it
+                if not deleteLoadSet(token, config, repertoire_id, load_set):
+                    raise RuntimeError('could not delete incomplete load set ' + str(load_set) + ' of repertoire ' + repertoire_id)
+    else:
+        print('Starting load set: ' + str(load_set_start))
+        if load_set_end is not None:
+            print('Ending load set: ' + str(load_set_end - 1))
+            # loading over a load set that was not deleted would duplicate it
+            for load_set in range(load_set_start, load_set_end):
+                # the load sets may belong to another worker by now
+                if abort is not None and abort.is_set():
+                    raise RuntimeError('load of repertoire ' + repertoire_id + ' was aborted')
+                if not deleteLoadSet(token, config, repertoire_id, load_set):
+                    raise RuntimeError('could not delete load set ' + str(load_set) + ' of repertoire ' + repertoire_id)
+        elif load_set_start == 0:
+            deleteRearrangements(token, config, repertoire_id)
+        else:
+            deleteLoadSet(token, config, repertoire_id, load_set_start)
+        if journal:
+            journalReset(journal, repertoire_id, load_set_start, load_set_end)
+
+    primary_dp = getPrimaryDataProcessing(rep)
+    # seeking needs the load set index, build it if missing
+    use_index = args.build_index or args.resume or load_set_start > 0 or load_set_end is not None
+    if args.build_index:
+        for f in primary_dp['data_processing_files']:
+            getLoadSetIndex(findRearrangementFile(args.file_prefix, primary_dp, f), load_set_size)
+
+    stats = newLoadStats()
+    if args.plan:
+        stats['planned_records'] = planRows(readLoadPlan(args.plan), repertoire_id, load_set_start, load_set_end)
+    load_sets = generateLoadSets(rep, primary_dp, args.file_prefix, load_set_size, load_set_start, stats, args.transform_processes, options, load_set_end, use_index, skip_load_sets, args.fast_reader)
+    # statistics need every load set, which is only read for a complete load
+    tally = None
+    if args.statistics:
+        if args.resume or load_set_start > 0 or load_set_end is not None:
+            print('WARNING: statistics are not updated when loading part of a repertoire')
+        else:
+            tally = newFacetTally()
+            load_sets = tallyLoadSets(load_sets, tally)
+    if journal:
+        load_sets = digestLoadSets(token, config, repertoire_id, load_sets, journal, stats, args.incremental)
+    if args.workers > 1:
+        loadPipelined(token, config, repertoire_id, load_sets, args.workers, stats, journal, control, abort)
+    else:
+        for load_set, records in load_sets:
+            if abort is not None and abort.is_set():
+                break
+            uploadLoadSet(token, config, repertoire_id, load_set, records, stats, journal, control, abort)
+            print('Total records: ' + str(stats['upload_records']))
+    print("Total records inserted: " + str(stats['upload_records']))
+    if abort is not None and abort.is_set():
+        raise RuntimeError('load of repertoire ' + repertoire_id + ' was aborted')
+    if tally:
+        if stats['upload_errors'] > 0:
+            print('WARNING: statistics are not updated as some load sets failed')
+        else:
+            writeStatistics(token, config, statisticsDocument(tally, repertoire_id, primary_dp['data_processing_id']), args.statistics_collection)
+    printLoadStats(stats)
+    if sink:
+        printSinkStats(sink)
+
+    return {
+        "repertoire_id": repertoire_id,
+        "read_records": stats['read_records'],
+        "inserted": stats['upload_records'],
+        "load_sets": stats['upload_sets'],
+        "errors": stats['upload_errors'],
+        "elapsed": time.time() - stats['start']
+    }
+
+# Total size of the rearrangement files, to schedule the largest repertoires first
+def repertoireSize(rep, file_prefix):
+    primary_dp = getPrimaryDataProcessing(rep)
+    size = 0
+    for f in primary_dp['data_processing_files']:
+        size += os.path.getsize(findRearrangementFile(file_prefix, primary_dp, f))
+    return size
+
+def initRepertoireWorker(semaphore):
+    setRequestLimit(semaphore)
+
+# Process pool entry point, each process has its own
+# configuration, session and journal connection
+def loadRepertoireInProcess(rep, args, load_set_start, load_set_end):
+    journal = None
+    if args.journal:
+        journal = openLoadJournal(args.journal)
+    config = loadConfig(args)
+    try:
+        return loadRepertoire(rep, args, config, transformOptions(args), batchControl(args), journal, load_set_start, load_set_end)
+    finally:
+        if journal:
+            closeLoadJournal(journal)
+        if config.get('sink'):
+            closeLoadSink(config['sink'])
+        if config.get('mongo'):
+            closeMongoBackend(config['mongo'])
+
+# Keep extending the lease of a work unit while it loads. If the lease
+# is lost, or cannot be extended for 2/3 of the timeout so it could
+# expire, lost is set so the load stops before another worker claims
+# the unit and reloads it.
+def leaseHeartbeat(work_queue, uid, worker, timeout, stop, lost):
+    extended = time.time()
+    while not stop.wait(timeout / 3):
+        try:
+            if not extendLease(work_queue, uid, worker, timeout):
+                lost.set()
+                return
+            extended = time.time()
+        except Exception as e:
+            print('WARNING: could not extend lease of work unit ' + uid + ': ' + str(e))
+            if time.time() - extended >= timeout * 2 / 3:
+                lost.set()
+                return
+
+# Claim work units from the load queue and load them until the queue is empty
+def runWorker(args, config, options, control, journal):
+    work_queue = openLoadQueue(args.queue_url, args.queue_name)
+    worker = socket.gethostname() + ':' + str(os.getpid())
+    print('Worker ' + worker + ' on queue: ' + args.queue_name)
+    summaries = []
+    while True:
+        claimed = claimUnit(work_queue, worker, args.visibility_timeout)
+        if claimed is None:
+            status = queueStatus(work_queue)
+            if status['pending'] == 0 and status['claimed'] == 0:
+                break
+            # units claimed by other workers come back if their lease expires
+            time.sleep(args.poll_interval)
+            continue
+
+        uid, unit, attempt = claimed
+        print('Claimed work unit: ' + uid + ', attempt ' + str(attempt) + ' of ' + str(args.max_attempts))
+        unit_args = argparse.Namespace(**vars(args))
+        unit_args.load_set_size = unit['load_set_size']
+        if args.file_prefix is None:
+            unit_args.file_prefix = unit['file_prefix']
+        stop = threading.Event()
+        lost = threading.Event()
+        heartbeat = threading.Thread(target=leaseHeartbeat, args=(work_queue, uid, worker, args.visibility_timeout, stop, lost), daemon=True)
+        heartbeat.start()
+        summary = None
+        error = None
+        try:
+            # loading a range of load sets deletes them first, so a
+            # unit loaded again after a failure is not duplicated
+            # the inserts stop as soon as the lease is lost
+            summary = loadRepertoire(unit['repertoire'], unit_args, config, options, control, journal, unit['load_set_start'], unit['load_set_end'], lost)
+            if summary['errors'] > 0:
+                error = str(summary['errors']) + ' load sets failed to upload'
+            elif summary['read_records'] != unit['rows']:
+                error = 'read ' + str(summary['read_records']) + ' rows but the plan has ' + str(unit['rows'])
+        except Exception as e:
+            error = str(e)
+        finally:
+            stop.set()
+            heartbeat.join()
+
+        lost_message = 'WARNING: lost the lease of work unit ' + uid + ' on attempt ' + str(attempt) + ', it will be loaded again'
+        if lost.is_set():
+            print(lost_message)
+        elif error is None:
+            if completeUnit(work_queue, uid, worker, summary):
+                summaries.append(summary)
+            else:
+                print(lost_message)
+        else:
+            if failUnit(work_queue, uid, worker, error, args.max_attempts):
+                print('ERROR: work unit ' + uid + ' failed, attempt ' + str(attempt) + ' of ' + str(args.max_attempts) + ': ' + error)
+            else:
+                print(lost_message)
+            if summary:
+                summaries.append(summary)
+    return summaries
+
+def printLoadSummary(summaries):
+    print('')
+    print('repertoire_id\tread\tinserted\tload_sets\terrors\tsecs')
+    for s in summaries:
+        print(s['repertoire_id'] + '\t' + str(s['read_records']) + '\t' + str(s['inserted']) + '\t' + str(s['load_sets'])
+              + '\t' + str(s['errors']) + '\t' + '{:.1f}'.format(s['elapsed']))
+    print('Total records inserted: ' + str(sum(s['inserted'] for s in summaries)))
+    errors = sum(s['errors'] for s in summaries)
+    if errors > 0:
+        print('ERROR: ' + str(errors) + ' load sets failed to upload')
 
 # main entry
 if (__name__=="__main__"):
     parser = argparse.ArgumentParser(description='Load AIRR rearrangements into VDJServer data repository.')
-    parser.add_argument('load_set_start', type=int, help='Starting load set')
-    parser.add_argument('repertoire_file', type=str, help='AIRR repertoire metadata file name')
-    parser.add_argument('file_prefix', type=str, help='Directory prefix to find the rearrangements files')
+    parser.add_argument('load_set_start', type=int, nargs='?', default=0, help='Starting load set')
+    parser.add_argument('repertoire_file', type=str, nargs='?', help='AIRR repertoire metadata file name')
+    parser.add_argument('file_prefix', type=str, nargs='?', help='Directory prefix to find the rearrangements files')
+    parser.add_argument('--load-set-end', type=int, help='Stop before this load set, for reloading a range of load sets')
+    parser.add_argument('--build-index', action='store_true', help='Build load set indexes for the files before loading')
+    parser.add_argument('--journal', type=str, help='Load journal file recording the load sets acknowledged by the server')
+    parser.add_argument('--resume', action='store_true', help='Only load the load sets that the journal does not have as inserted')
+    parser.add_argument('--incremental', action='store_true', help='Only replace the load sets whose contents changed since the journal recorded them')
+    parser.add_argument('--load-set-size', type=int, default=1000, help='Rows per load set (default: 1000)')
+    parser.add_argument('--plan', type=str, help='Load plan from load_plan.py, for progress and the load set size')
+    parser.add_argument('--work-unit', type=int, help='Only load this work unit of the --plan')
+    parser.add_argument('--worker', action='store_true', help='Load work units from the load queue instead of a repertoire file, see load_queue.py')
+    parser.add_argument('--queue-url', type=str, default=default_queue_url, help='Redis URL of the load queue (default: ADC_LOAD_QUEUE_URL or redis://localhost:6379/0)')
+    parser.add_argument('--queue-name', type=str, default='rearrangement', help='Name of the load queue (default: rearrangement)')
+    parser.add_argument('--visibility-timeout', type=float, default=300, help='Seconds before the work unit of a worker that stopped responding is loaded again (default: 300)')
+    parser.add_argument('--max-attempts', type=int, default=3, help='Attempts at a work unit before it is marked failed (default: 3)')
+    parser.add_argument('--poll-interval', type=float, default=5, help='Seconds between checks for work units while other workers finish (default: 5)')
+    parser.add_argument('--adaptive-batch', action='store_true', help='Adapt the records per insert request to payload size and latency')
+    parser.add_argument('--min-batch', type=int, default=50, help='Minimum records per insert request for --adaptive-batch (default: 50)')
+    parser.add_argument('--max-batch', type=int, help='Maximum records per insert request for --adaptive-batch (default: load set size)')
+    parser.add_argument('--target-bytes', type=int, default=4000000, help='Target payload bytes per insert request for --adaptive-batch (default: 4000000)')
+    parser.add_argument('--target-latency', type=float, default=10.0, help='Target seconds per insert request for --adaptive-batch (default: 10)')
+    parser.add_argument('--json-encoder', type=str, choices=json_encoders, help='JSON encoder for insert requests (default: auto, the fastest installed)')
+    parser.add_argument('--compression', type=str, choices=compressions, help='Content-Encoding for insert requests (default: none)')
+    parser.add_argument('--stream-body', action='store_true', help='Encode insert requests as they are sent instead of building the whole body first')
+    parser.add_argument('--workers', type=int, default=1, help='Number of parallel upload workers (default: 1, no pipelining)')
+    parser.add_argument('--parallel-repertoires', type=int, default=1, help='Number of repertoires to load at once in separate processes (default: 1)')
+    parser.add_argument('--max-requests', type=int, help='Maximum insert and delete requests in flight across all processes')
+    parser.add_argument('--junction-mode', type=str, default='all', choices=junction_modes, help='junction_aa substring expansion (default: all)')
+    parser.add_argument('--junction-max-length', type=int, default=8, help='Maximum substring length for --junction-mode max (default: 8)')
+    parser.add_argument('--prune', type=str, default='none', choices=prune_modes, help='Remove null (null) or null and empty string (empty) fields from rearrangements (default: none)')
+    parser.add_argument('--keep-fields', type=str, help='Comma separated fields that --prune never removes')
+    parser.add_argument('--germline-alleles', type=str, help='IMGT germline FASTA or allele list to preload the gene call cache')
+    parser.add_argument('--fast-reader', action='store_true', help='Read the TSV files with the faster reader instead of the airr reader')
+    parser.add_argument('--transform-processes', type=int, default=0, help='Number of processes to transform rows (default: 0, transform in the reader)')
+    parser.add_argument('--statistics', action='store_true', help='Count facet statistics for each repertoire and store them when the load finishes')
+    parser.add_argument('--statistics-collection', type=str, default=default_statistics_collection, help='Collection for the --statistics documents (default: ' + default_statistics_collection + ')')
+    parser.add_argument('--sink', type=str, choices=sink_kinds, help='Write to a local sink instead of the repository, for benchmarks')
+    parser.add_argument('--sink-path', type=str, default='.', help='Directory for the jsonl and bson sink files (default: current directory)')
+    parser.add_argument('--backend', type=str, default='api', choices=['api', 'mongo'], help='Insert through the Meta V3 API or directly into MongoDB (default: api)')
+    parser.add_argument('--mongo-uri', type=str, default=os.getenv('ADC_LOAD_MONGO_URI', 'mongodb://localhost:27017'), help='MongoDB connection string for --backend mongo (default: ADC_LOAD_MONGO_URI or mongodb://localhost:27017)')
+    parser.add_argument('--mongo-db', type=str, help='Database for --backend mongo (default: MONGODB_DB from the .env file)')
+    parser.add_argument('--write-concern', type=str, help='Write concern w for --backend mongo, a number or majority (default: server default)')
+    parser.add_argument('--write-journal', action='store_true', default=None, help='Wait for the MongoDB journal for --backend mongo (default: server default)')
+    parser.add_argument('--api-url', type=str, help='Base URL of the API server instead of the .env file, such as http://localhost:8080 for mock_restheart.py')
     args = parser.parse_args()
 
-    load_set_size = 1000
-
     if args:
+        if args.worker:
+            if redis is None:
+                print('ERROR: --worker requires the redis module')
+                sys.exit(1)
+            if args.resume or args.incremental or args.plan or args.work_unit is not None or args.parallel_repertoires > 1:
+                print('ERROR: --worker loads the work units of the queue, it cannot be used with --resume, --incremental, --plan or --parallel-repertoires')
+                sys.exit(1)
+        elif args.repertoire_file is None or args.file_prefix is None:
+            parser.error('load_set_start, repertoire_file and file_prefix are required')
+        if args.junction_max_length < 4:
+            parser.error('--junction-max-length must be at least 4, the shortest junction substring')
+        if args.resume and not args.journal:
+            print('ERROR: --resume requires --journal')
+            sys.exit(1)
+        if args.incremental:
+            if not args.journal:
+                print('ERROR: --incremental requires --journal')
+                sys.exit(1)
+            if args.resume or args.sink or args.load_set_start != 0 or args.load_set_end is not None or args.work_unit is not None:
+                print('ERROR: --incremental compares all load sets, it cannot be used with --resume, --sink or a range of load sets')
+                sys.exit(1)
+        if args.backend == 'mongo' and pymongo is None:
+            print('ERROR: --backend mongo requires the pymongo module')
+            sys.exit(1)
+        if args.sink == 'bson' and bson is None:
+            print('ERROR: --sink bson requires the pymongo module')
+            sys.exit(1)
+
+        # preload before the transform processes are forked so they share it
+        if args.germline_alleles:
+            preloadGeneCalls(args.germline_alleles)
+
+        semaphore = None
+        if args.max_requests:
+            semaphore = multiprocessing.BoundedSemaphore(args.max_requests)
+            setRequestLimit(semaphore)
+
+        if args.worker:
+            journal = None
+            if args.journal:
+                journal = openLoadJournal(args.journal)
+            config = loadConfig(args)
+            summaries = runWorker(args, config, transformOptions(args), batchControl(args), journal)
+            if config.get('sink'):
+                closeLoadSink(config['sink'])
+            if config.get('mongo'):
+                closeMongoBackend(config['mongo'])
+            printLoadSummary(summaries)
+            sys.exit(0)
+
         data = airr.load_repertoire(args.repertoire_file)
         reps = data['Repertoire']
 
-        load_set_start = args.load_set_start
-        for rep in reps:
-            config = getConfig()
-            token = getToken(config)
-            print(token['access_token'])
-
-            print('Loading AIRR rearrangements for repertoire: ' + rep['repertoire_id'])
-            print('Starting load set: ' + str(load_set_start))
-            deleteLoadSet(token, config, rep['repertoire_id'], load_set_start)
-            load_set = 0
-
-            primary_dp = None
-            for dp in rep['data_processing']:
-                if dp.get('primary_annotation'):
-                    primary_dp = dp
-            if not primary_dp:
-                print('ERROR: Repertoire missing primary data processing: ' + rep['repertoire_id'])
-                sys.exit(1)
-
-            files = primary_dp['data_processing_files']
-            for f in files:
-                if os.path.isfile(args.file_prefix + '/' + f):
-                    print('AIRR rearrangement file: ' + args.file_prefix + '/' + f)
-                    reader = airr.read_rearrangement(args.file_prefix + '/' + f)
-                elif os.path.isfile(args.file_prefix + '/' + primary_dp['data_processing_id'] + '/' + f):
-                    print('AIRR rearrangement file: ' + args.file_prefix + '/' + primary_dp['data_processing_id'] + '/' + f)
-                    reader = airr.read_rearrangement(args.file_prefix + '/' + primary_dp['data_processing_id'] + '/' + f)
-                else:
-                    print('ERROR: cannot find file: ' + f)
+        if args.plan:
+            plan = readLoadPlan(args.plan)
+            if args.load_set_size != plan['load_set_size']:
+                print('Using the load set size of the plan: ' + str(plan['load_set_size']))
+                args.load_set_size = plan['load_set_size']
+            if args.work_unit is not None:
+                if args.work_unit < 0 or args.work_unit >= len(plan['work_units']):
+                    print('ERROR: plan does not have work unit: ' + str(args.work_unit))
+                    sys.exit(1)
+                # load just the load sets of the work unit
+                unit = plan['work_units'][args.work_unit]
+                print('Loading work unit ' + str(args.work_unit) + ': repertoire ' + unit['repertoire_id']
+                      + ' load sets ' + str(unit['load_set_start']) + ' to ' + str(unit['load_set_end'] - 1))
+                reps = [ rep for rep in reps if rep['repertoire_id'] == unit['repertoire_id'] ]
+                if len(reps) == 0:
+                    print('ERROR: repertoire of work unit not in ' + args.repertoire_file + ': ' + unit['repertoire_id'])
                     sys.exit(1)
+                args.load_set_start = unit['load_set_start']
+                args.load_set_end = unit['load_set_end']
+        elif args.work_unit is not None:
+            print('ERROR: --work-unit requires --plan')
+            sys.exit(1)
 
-                total = 0
-                cnt = 0
-                records = []
-                for r in reader:
-                    if r.get('repertoire_id') is None:
-                        r['repertoire_id'] = rep['repertoire_id']
-                    if len(r['repertoire_id']) == 0:
-                        r['repertoire_id'] = rep['repertoire_id']
-                    if r.get('data_processing_id') is None:
-                        r['data_processing_id'] = primary_dp['data_processing_id']
-                    if len(r['data_processing_id']) == 0:
-                        r['data_processing_id'] = primary_dp['data_processing_id']
-                    r['vdjserver_load_set'] = load_set
-                    
-                    r['receptor_id'] = r['sequence_id']
-                    del r['sequence_id']
-
-                    changeGeneCall('v_call', 'v_gene', 'v_subgroup', r)
-                    changeGeneCall('d_call', 'd_gene', 'd_subgroup', r)
-                    changeGeneCall('j_call', 'j_gene', 'j_subgroup', r)
-
-                    if len(r['junction_aa']) > 3:
-                        r['vdjserver_junction_substrings'] = getAllSubstrings(r['junction_aa'], 4)
-
-                    records.append(r)
-                    cnt += 1
-                    total += 1
-                    if cnt == load_set_size:
-                        if load_set >= load_set_start:
-                            print('Inserting load set: ' + str(load_set))
-                            insertRearrangement(token, config, records)
-                            print('Total records: ' + str(total))
-                        else:
-                            print('Skipping load set: ' + str(load_set))
-                        cnt = 0
-                        load_set += 1
-                        records = []
-                if cnt != 0:
-                    if load_set >= load_set_start:
-                        print('Inserting load set: ' + str(load_set))
-                        insertRearrangement(token, config, records)
-                        print('Total records: ' + str(total))
-                    else:
-                        print('Skipping load set: ' + str(load_set))
-                    load_set += 1
-                print("Total records inserted: " + str(total))
-            load_set_start = 0
+        # the starting and ending load sets only apply to the first repertoire
+        summaries = []
+        if args.parallel_repertoires > 1:
+            ranges = { reps[0]['repertoire_id']: (args.load_set_start, args.load_set_end) }
+            reps = sorted(reps, key=lambda rep: repertoireSize(rep, args.file_prefix), reverse=True)
+            with concurrent.futures.ProcessPoolExecutor(max_workers=args.parallel_repertoires, initializer=initRepertoireWorker, initargs=(semaphore,)) as pool:
+                futures = []
+                for rep in reps:
+                    load_set_start, load_set_end = ranges.get(rep['repertoire_id'], (0, None))
+                    futures.append(pool.submit(loadRepertoireInProcess, rep, args, load_set_start, load_set_end))
+                for rep, future in zip(reps, futures):
+                    try:
+                        summaries.append(future.result())
+                    except Exception as e:
+                        print('ERROR: repertoire ' + rep['repertoire_id'] + ' failed: ' + str(e))
+                        summaries.append({ "repertoire_id": rep['repertoire_id'], "read_records": 0, "inserted": 0, "load_sets": 0, "errors": 1, "elapsed": 0.0 })
+        else:
+            journal = None
+            if args.journal:
+                journal = openLoadJournal(args.journal)
+            config = loadConfig(args)
+            options = transformOptions(args)
+            control = batchControl(args)
+
+            load_set_start = args.load_set_start
+            load_set_end = args.load_set_end
+            for rep in reps:
+                summaries.append(loadRepertoire(rep, args, config, options, control, journal, load_set_start, load_set_end))
+                load_set_start = 0
+                load_set_end = None
+            if config.get('sink'):
+                closeLoadSink(config['sink'])
+            if config.get('mongo'):
+                closeMongoBackend(config['mongo'])
+
+        if len(summaries) > 1:
+            printLoadSummary(summaries)
@@ -4,46 +4,12 @@
 #
 
 import json
-from dotenv import load_dotenv
-import os
+import sys
 import airr
 import yaml
 import requests
 import argparse
-
-# Setup
-def getConfig():
-    if load_dotenv(dotenv_path='/api-js-tapis/.env'):
-        cfg = {}
-        cfg['api_server'] = os.getenv('WSO2_HOST')
-        cfg['api_key'] = os.getenv('WSO2_CLIENT_KEY')
-        cfg['api_secret'] = os.getenv('WSO2_CLIENT_SECRET')
-        cfg['username'] = os.getenv('VDJ_SERVICE_ACCOUNT')
-        cfg['password'] = os.getenv('VDJ_SERVICE_ACCOUNT_SECRET')
-        cfg['dbname'] = os.getenv('MONGODB_DB')
-        return cfg
-    else:
-        print('ERROR: loading config')
-        return None
-
-# Fetches a user token based on the supplied auth object
-# and returns the auth object with token data on success
-def getToken(config):
-    data = {
-        "grant_type":"password",
-        "scope":"PRODUCTION",
-        "username":config['username'],
-        "password":config['password']
-    }
-    headers = {
-        "Content-Type":"application/x-www-form-urlencoded"
-    }
-
-    url = 'https://' + config['api_server'] + '/token'
-
-    resp = requests.post(url, data=data, headers=headers, auth=(config['api_key'], config['api_secret']))
-    token = resp.json()
-    return token
+from adc_client import getConfig, getToken, getSession
 
 # Cleans the object by removing fields with null or empty string values
 def cleanObject(obj):
@@ -78,14 +44,14 @@ def insertRepertoire(token, config, rep):
     # delete that repertoire_id
     url = 'https://' + config['api_server'] + '/meta/v3/' + config['dbname'] + '/repertoire/*?filter=' + requests.utils.quote('{"repertoire_id":"' + rep['repertoire_id'] + '"}')
     print(url)
-    resp = requests.delete(url, headers=headers)
+    resp = getSession(config).delete(url, headers=headers)
     print(resp)
     print(resp.json())
 
     # insert the repertoire
     url = 'https://' + config['api_server'] + '/meta/v3/' + config['dbname'] + '/repertoire/'
     data = [ rep ]
-    resp = requests.post(url, json=data, headers=headers)
+    resp = getSession(config).post(url, json=data, headers=headers)
     print(resp)
     print(resp.json())
 
@@ -3,46 +3,10 @@
 #
 
 import json
-from dotenv import load_dotenv
-import os
 import airr
 import yaml
-import requests
 import argparse
-
-# Setup
-def getConfig():
-    if load_dotenv(dotenv_path='/api-js-tapis/.env'):
-        cfg = {}
-        cfg['api_server'] = os.getenv('WSO2_HOST')
-        cfg['api_key'] = os.getenv('WSO2_CLIENT_KEY')
-        cfg['api_secret'] = os.getenv('WSO2_CLIENT_SECRET')
-        cfg['username'] = os.getenv('VDJ_SERVICE_ACCOUNT')
-        cfg['password'] = os.getenv('VDJ_SERVICE_ACCOUNT_SECRET')
-        cfg['dbname'] = os.getenv('MONGODB_DB')
-        return cfg
-    else:
-        print('ERROR: loading config')
-        return None
-
-# Fetches a user token based on the supplied auth object
-# and returns the auth object with token data on success
-def getToken(config):
-    data = {
-        "grant_type":"password",
-        "scope":"PRODUCTION",
-        "username":config['username'],
-        "password":config['password']
-    }
-    headers = {
-        "Content-Type":"application/x-www-form-urlencoded"
-    }
-
-    url = 'https://' + config['api_server'] + '/token'
-
-    resp = requests.post(url, data=data, headers=headers, auth=(config['api_key'], config['api_secret']))
-    token = resp.json()
-    return token
+from adc_client import getConfig, getToken, getSession
 
 # show collections
 def showCollections(token, config):
@@ -53,7 +17,7 @@ def showCollections(token, config):
     }
 
     url = 'https://' + config['api_server'] + '/meta/v3/' + config['dbname'] + '/'
-    resp = requests.get(url, headers=headers)
+    resp = getSession(config).get(url, headers=headers)
     print(json.dumps(resp.json(), indent=2))
 
 # show indexes
@@ -65,7 +29,7 @@ def showIndexes(token, config, collection):
     }
 
     url = 'https://' + config['api_server'] + '/meta/v3/' + config['dbname'] + '/' + collection + '/_indexes'
-    resp = requests.get(url, headers=headers)
+    resp = getSession(config).get(url, headers=headers)
     print(json.dumps(resp.json(), indent=2))
 
 # main entry
@@ -0,0 +1,108 @@
+#
+# Tests for the load set index and row counts of rearrangement files,
+# compared with the csv reader that reads the rows for the loader.
+#
+# Run with: python -m pytest test_rearrangement_files.py
+#
+
+import csv
+import gzip
+import io
+import os
+import random
+import tempfile
+from rearrangement_files import scanLoadSets, countRows
+
+header = 'sequence_id\tjunction_aa\tv_call\n'
+
+# a quote inside an unquoted field is a plain character, quoted fields
+# can have tabs, newlines and "" for a quote, and blank lines are skipped
+quote_rows = [
+    'seq1\tCAS"X\tIGHV1-2*01\n',
+    'seq2\tCASSF\tIGHV1-2*01\n',
+    '\n',
+    'seq3\t"CAS\nSF"\tIGHV1-2*01\n',
+    'seq4\t"CA""S\tSF"x"y\tIGHV1-2*01\r\n',
+    '\r\n',
+    'seq5\tC"\t"IGHV1-2*01"\n',
+    'seq6\t""\tIGHV1-2*01\n',
+    'seq7\tCASS"\tIGHV1-2*01'
+]
+
+def writeFile(filename, text):
+    data = text.encode('utf-8')
+    if filename.endswith('.gz'):
+        data = gzip.compress(data)
+    with open(filename, 'wb') as f:
+        f.write(data)
+
+def readText(filename):
+    with open(filename, 'rb') as f:
+        data = f.read()
+    if filename.endswith('.gz'):
+        data = gzip.decompress(data)
+    return data
+
+# the rows after the header, as the csv reader reads them
+def csvRows(data):
+    reader = csv.reader(io.TextIOWrapper(io.BytesIO(data), encoding='utf-8', newline=''), dialect='excel-tab')
+    next(reader)
+    return [ row for row in reader if row != [] ]
+
+def checkLoadSets(filename, load_set_size):
+    data = readText(filename)
+    rows = csvRows(data)
+    index = scanLoadSets(filename, load_set_size)
+    assert index['rows'] == len(rows)
+    assert len(index['offsets']) == (len(rows) + load_set_size - 1) // load_set_size
+    # reading from each offset starts at the first row of the load set
+    for i, offset in enumerate(index['offsets']):
+        assert csvRows(data[:len(data.split(b'\n', 1)[0]) + 1] + data[offset:])[0] == rows[i * load_set_size]
+
+def testScanLoadSetsQuotes():
+    with tempfile.TemporaryDirectory() as d:
+        for name in [ 'quotes.airr.tsv', 'quotes.airr.tsv.gz' ]:
+            filename = os.path.join(d, name)
+            writeFile(filename, header + ''.join(quote_rows))
+            for load_set_size in [ 1, 2, 3, 1000 ]:
+                checkLoadSets(filename, load_set_size)
+
+def testScanLoadSetsQuoteInField():
+    with tempfile.TemporaryDirectory() as d:
+        filename = os.path.join(d, 'field.airr.tsv')
+        writeFile(filename, header + 'seq1\tCAS"X\tIGHV1-2*01\nseq2\tCASSF\tIGHV1-2*01\nseq3\tCASSG\tIGHV1-2*01\n')
+        index = scanLoadSets(filename, 1)
+        assert index['rows'] == 3
+        checkLoadSets(filename, 1)
+
+def testCountRowsQuotes():
+    with tempfile.TemporaryDirectory() as d:
+        for name in [ 'quotes.airr.tsv', 'quotes.airr.tsv.gz' ]:
+            filename = os.path.join(d, name)
+            writeFile(filename, header + ''.join(quote_rows))
+            rows = len(csvRows(readText(filename)))
+            for block_size in [ 1, 2, 3, 7, 1 << 24 ]:
+                assert countRows(filename, block_size, use_index=False) == rows
+
+# pieces of random files, mostly the characters that change how rows are split
+fuzz_tokens = [ 'A', 'C', 'A', 'C', '\t', '\t', '\n', '\n', '\r\n', '"', '"', '""' ]
+
+# Random files, the block sizes split them at every position
+def testCountRowsFuzz():
+    rng = random.Random(23)
+    with tempfile.TemporaryDirectory() as d:
+        for n in range(300):
+            filename = os.path.join(d, 'fuzz' + str(n) + ('.airr.tsv.gz' if n % 5 == 0 else '.airr.tsv'))
+            writeFile(filename, header + ''.join([ rng.choice(fuzz_tokens) for i in range(rng.randint(0, 80)) ]))
+            rows = len(csvRows(readText(filename)))
+            assert scanLoadSets(filename, 1000)['rows'] == rows, filename
+            for block_size in [ 1, 2, 3, 5, 16, 1 << 24 ]:
+                assert countRows(filename, block_size, use_index=False) == rows, filename
+
+# main entry
+if (__name__=="__main__"):
+    testScanLoadSetsQuotes()
+    testScanLoadSetsQuoteInField()
+    testCountRowsQuotes()
+    testCountRowsFuzz()
+    print('PASS')
@@ -0,0 +1,203 @@
+#
+# Verify the contents of loaded rearrangements against the files with a
+# sample of rows. This assumes you are running in the docker container.
+#
+# Every k-th row of each load set, and the last row, is transformed like
+# the loader does and fingerprinted with a hash of its fields. The same
+# rows are fetched from the repository by load set and receptor_id in
+# batches, several at a time, and their fingerprints are compared. Fields
+# that are null or empty are left out of the fingerprint, so pruned loads
+# compare the same, as are the junction substring fields, which depend on
+# the junction mode and are derived from junction_aa. Rows that are missing, duplicated or
+# different are reported, with the fields that differ.
+#
+
+import json
+import hashlib
+import urllib.parse
+import sys
+import time
+import argparse
+import concurrent.futures
+import airr
+from adc_client import apiConfig, getToken, queryDocuments
+from rearrangement_files import getPrimaryDataProcessing
+from rearrangement_load import readRawLoadSets, transformRearrangement
+
+# fields added by the repository or derived from other fields
+ignore_fields = [ '_id', '_etag', 'vdjserver_junction_substrings', 'vdjserver_junction_suffixes' ]
+
+# keep the query URLs well under the usual 8 KB limit of gateways
+max_filter_length = 6000
+
+# the sampled rows are only transformed, without the junction substrings
+verify_transform_options = {
+    "junction_mode": "none",
+    "junction_max_length": None,
+    "prune": "none",
+    "keep_fields": ()
+}
+
+# extended JSON numbers from the repository as plain values
+def plainValue(value):
+    if isinstance(value, dict) and len(value) == 1:
+        k, v = next(iter(value.items()))
+        if k in ('$numberLong', '$numberInt'):
+            return int(v)
+        if k == '$numberDouble':
+            return float(v)
+    return value
+
+def normalizeRecord(r):
+    result = {}
+    for k, v in r.items():
+        if k in ignore_fields:
+            continue
+        v = plainValue(v)
+        if v is None or v == '':
+            continue
+        result[k] = list(v) if isinstance(v, tuple) else v
+    return result
+
+def fingerprint(r):
+    return hashlib.sha256(json.dumps(normalizeRecord(r), sort_keys=True, separators=(',', ':')).encode('utf-8')).hexdigest()
+
+# Fields with different values, for the report
+def differentFields(expected, actual):
+    a = normalizeRecord(expected)
+    b = normalizeRecord(actual)
+    return sorted([ k for k in set(a) | set(b) if a.get(k) != b.get(k) ])
+
+# Every k-th row of the load set and the last row
+def sampleRows(records, sample_every):
+    rows = records[::sample_every]
+    if len(records) > 0 and (len(records) - 1) % sample_every != 0:
+        rows.append(records[-1])
+    return rows
+
+# Split the sampled rows into chunks whose query filter fits in a URL,
+# counting the load set of every row although most of them repeat
+def sampleChunks(sample, max_length=max_filter_length):
+    chunks = []
+    chunk = []
+    length = 0
+    for r in sample:
+        row_length = len(urllib.parse.quote(json.dumps(r['receptor_id']))) + len(urllib.parse.quote(json.dumps(r['vdjserver_load_set']))) + 12
+        if len(chunk) > 0 and length + row_length > max_length:
+            chunks.append(chunk)
+            chunk = []
+            length = 0
+        chunk.append(r)
+        length += row_length
+    if len(chunk) > 0:
+        chunks.append(chunk)
+    return chunks
+
+# Fetch the sampled rows by load set and receptor_id, as receptor_id
+# can repeat across the files of a repertoire, with a query per chunk
+def fetchSample(token, config, collection, repertoire_id, sample):
+    found = {}
+    for chunk in sampleChunks(sample):
+        load_sets = sorted(set([ r['vdjserver_load_set'] for r in chunk ]))
+        query = { "repertoire_id": repertoire_id, "vdjserver_load_set": { "$in": load_sets },
+                  "receptor_id": { "$in": sorted(set([ r['receptor_id'] for r in chunk ])) } }
+        for doc in queryDocuments(token, config, collection, query, pagesize=len(chunk) + 1):
+            found.setdefault((plainValue(doc.get('vdjserver_load_set')), doc.get('receptor_id')), []).append(doc)
+    return found
+
+def newVerifyStats():
+    return { "rows": 0, "sampled": 0, "matched": 0, "missing": 0, "duplicated": 0, "different": 0 }
+
+def compareSample(expected, found, stats, max_report):
+    for r in expected:
+        stats['sampled'] += 1
+        docs = found.get((r['vdjserver_load_set'], r['receptor_id']), [])
+        problem = None
+        if len(docs) == 0:
+            stats['missing'] += 1
+            problem = 'missing'
+        elif len(docs) > 1:
+            stats['duplicated'] += 1
+            problem = 'duplicated ' + str(len(docs)) + ' times'
+        elif fingerprint(r) != fingerprint(docs[0]):
+            stats['different'] += 1
+            problem = 'different: ' + ', '.join(differentFields(r, docs[0]))
+        else:
+            stats['matched'] += 1
+        if problem and stats['sampled'] - stats['matched'] <= max_report:
+            print('ERROR: load set ' + str(r['vdjserver_load_set']) + ' receptor_id ' + str(r['receptor_id']) + ' is ' + problem)
+
+# Verify a sample of the rows of the repertoire
+def verifyRepertoire(token, config, args, rep):
+    repertoire_id = rep['repertoire_id']
+    primary_dp = getPrimaryDataProcessing(rep)
+    print('Verifying AIRR rearrangements for repertoire: ' + repertoire_id)
+    stats = newVerifyStats()
+    use_index = args.load_set_start > 0 or args.load_set_end is not None
+    raw_load_sets = readRawLoadSets(primary_dp, args.file_prefix, args.load_set_size, args.load_set_start, args.load_set_end, use_index, None, args.fast_reader)
+
+    batch = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.workers) as pool:
+        pending = []
+        for load_set, records in raw_load_sets:
+            if load_set < args.load_set_start:
+                continue
+            stats['rows'] += len(records)
+            for r in sampleRows(records, args.sample_every):
+                batch.append(transformRearrangement(dict(r), repertoire_id, primary_dp['data_processing_id'], load_set, verify_transform_options))
+            while len(batch) >= args.batch_size:
+                sample = batch[:args.batch_size]
+                batch = batch[args.batch_size:]
+                pending.append((sample, pool.submit(fetchSample, token, config, args.collection, repertoire_id, sample)))
+            # compare the finished batches, but keep a few in flight
+            while len(pending) > 2 * args.workers:
+                sample, future = pending.pop(0)
+                compareSample(sample, future.result(), stats, args.max_report)
+        if len(batch) > 0:
+            pending.append((batch, pool.submit(fetchSample, token, config, args.collection, repertoire_id, batch)))
+        for sample, future in pending:
+            compareSample(sample, future.result(), stats, args.max_report)
+
+    print('Repertoire ' + repertoire_id + ': ' + str(stats['rows']) + ' rows, ' + str(stats['sampled']) + ' sampled, ' + str(stats['matched']) + ' matched, '
+          + str(stats['missing']) + ' missing, ' + str(stats['duplicated']) + ' duplicated, ' + str(stats['different']) + ' different')
+    return stats
+
+# main entry
+if (__name__=="__main__"):
+    parser = argparse.ArgumentParser(description='Verify loaded AIRR rearrangements against the files with a sample of rows.')
+    parser.add_argument('repertoire_file', type=str, help='AIRR repertoire metadata file name')
+    parser.add_argument('file_prefix', type=str, help='Directory prefix to find the rearrangements files')
+    parser.add_argument('--collection', type=str, default='rearrangement', help='Rearrangement collection (default: rearrangement)')
+    parser.add_argument('--sample-every', type=int, default=100, help='Verify every k-th row of each load set, and the last row (default: 100)')
+    parser.add_argument('--load-set-size', type=int, default=1000, help='Rows per load set (default: 1000)')
+    parser.add_argument('--load-set-start', type=int, default=0, help='First load set to verify (default: 0)')
+    parser.add_argument('--load-set-end', type=int, help='Stop before this load set')
+    parser.add_argument('--batch-size', type=int, default=200, help='Rows fetched per batch, split into queries that fit in a URL (default: 200)')
+    parser.add_argument('--workers', type=int, default=4, help='Number of queries at once (default: 4)')
+    parser.add_argument('--max-report', type=int, default=20, help='Maximum rows to report per repertoire (default: 20)')
+    parser.add_argument('--fast-reader', action='store_true', help='Read the TSV files with the faster reader')
+    parser.add_argument('--api-url', type=str, help='Base URL of the API server instead of the .env file')
+    args = parser.parse_args()
+
+    if args:
+        if args.sample_every < 1 or args.batch_size < 1:
+            print('ERROR: --sample-every and --batch-size must be at least 1')
+            sys.exit(1)
+        config = apiConfig(args.api_url)
+        if config is None:
+            sys.exit(1)
+        config['pool_size'] = max(config['pool_size'], args.workers)
+        token = getToken(config)
+
+        data = airr.read_airr(args.repertoire_file)
+        t = time.time()
+        total = newVerifyStats()
+        for rep in data['Repertoire']:
+            stats = verifyRepertoire(token, config, args, rep)
+            for k in total:
+                total[k] += stats[k]
+        print('Verified ' + str(total['sampled']) + ' of ' + str(total['rows']) + ' rows in ' + '{:.1f}'.format(time.time() - t) + ' secs, '
+              + str(total['matched']) + ' matched')
+        if total['sampled'] != total['matched']:
+            print('ERROR: ' + str(total['sampled'] - total['matched']) + ' sampled rows are missing, duplicated or different')
+            sys.exit(1)
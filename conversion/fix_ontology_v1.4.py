@@ -5,49 +5,17 @@
 #
 
 import json
-from dotenv import load_dotenv
 import os
+import sys
 import airr
 import yaml
-import requests
 import argparse
 import urllib.parse
 from datetime import datetime
 import time
-
-# Setup
-def getConfig():
-    if load_dotenv(dotenv_path='/api-js-tapis/.env'):
-        cfg = {}
-        cfg['api_server'] = os.getenv('WSO2_HOST')
-        cfg['api_key'] = os.getenv('WSO2_CLIENT_KEY')
-        cfg['api_secret'] = os.getenv('WSO2_CLIENT_SECRET')
-        cfg['username'] = os.getenv('VDJ_SERVICE_ACCOUNT')
-        cfg['password'] = os.getenv('VDJ_SERVICE_ACCOUNT_SECRET')
-        cfg['dbname'] = os.getenv('MONGODB_DB')
-        return cfg
-    else:
-        print('ERROR: loading config')
-        return None
-
-# Fetches a user token based on the supplied auth object
-# and returns the auth object with token data on success
-def getToken(config):
-    data = {
-        "grant_type":"password",
-        "scope":"PRODUCTION",
-        "username":config['username'],
-        "password":config['password']
-    }
-    headers = {
-        "Content-Type":"application/x-www-form-urlencoded"
-    }
-
-    url = 'https://' + config['api_server'] + '/token'
-
-    resp = requests.post(url, data=data, headers=headers, auth=(config['api_key'], config['api_secret']))
-    token = resp.json()
-    return token
+# shared client lives with the load scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app', 'load'))
+from adc_client import getConfig, getToken, getSession
 
 # update metadata record
 def updateRecord(token, config, object):
@@ -62,7 +30,7 @@ def updateRecord(token, config, object):
         "Authorization": "Bearer " + token['access_token']
     }
     url = 'https://' + config['api_server'] + '/meta/v2/data/' + object['uuid']
-    resp = requests.post(url, data=json.dumps(object), headers=headers)
+    resp = getSession(config).post(url, data=json.dumps(object), headers=headers)
     print(json.dumps(resp.json(), indent=2))
     print('INFO: (', object['name'], ') object uuid', object['uuid'], 'updated.')
     return
@@ -79,7 +47,7 @@ def queryObjects(token, config, name, limit, offset, project_uuid):
     else:
         url = 'https://' + config['api_server'] + '/meta/v2/data?q=' + urllib.parse.quote('{"name":"' + name + '","associationIds":"' + project_uuid + '"}')
     url += '&limit=' + str(limit) + '&offset=' + str(offset)
-    resp = requests.get(url, headers=headers)
+    resp = getSession(config).get(url, headers=headers)
     #print(json.dumps(resp.json(), indent=2))
     result = resp.json()
     if result.get('result') is None:
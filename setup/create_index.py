@@ -5,46 +5,14 @@
 #
 
 import json
-from dotenv import load_dotenv
 import os
+import sys
 import airr
 import yaml
-import requests
 import argparse
-
-# Setup
-def getConfig():
-    if load_dotenv(dotenv_path='/api-js-tapis/.env'):
-        cfg = {}
-        cfg['api_server'] = os.getenv('WSO2_HOST')
-        cfg['api_key'] = os.getenv('WSO2_CLIENT_KEY')
-        cfg['api_secret'] = os.getenv('WSO2_CLIENT_SECRET')
-        cfg['username'] = os.getenv('VDJ_SERVICE_ACCOUNT')
-        cfg['password'] = os.getenv('VDJ_SERVICE_ACCOUNT_SECRET')
-        cfg['dbname'] = os.getenv('MONGODB_DB')
-        return cfg
-    else:
-        print('ERROR: loading config')
-        return None
-
-# Fetches a user token based on the supplied auth object
-# and returns the auth object with token data on success
-def getToken(config):
-    data = {
-        "grant_type":"password",
-        "scope":"PRODUCTION",
-        "username":config['username'],
-        "password":config['password']
-    }
-    headers = {
-        "Content-Type":"application/x-www-form-urlencoded"
-    }
-
-    url = 'https://' + config['api_server'] + '/token'
-
-    resp = requests.post(url, data=data, headers=headers, auth=(config['api_key'], config['api_secret']))
-    token = resp.json()
-    return token
+# shared client lives with the load scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app', 'load'))
+from adc_client import getConfig, getToken, getSession
 
 # Does a PUT of an index definition to the collection
 # An index must be deleted before it can be updated
@@ -57,13 +25,13 @@ def insertIndex(token, config, collection, name, index):
 
     # delete the index
     url = 'https://' + config['api_server'] + '/meta/v3/' + config['dbname'] + '/' + collection + '/_indexes/' + name
-    resp = requests.delete(url, headers=headers)
+    resp = getSession(config).delete(url, headers=headers)
     print(resp.status_code)
     print(resp.text)
 
     # put the index
     url = 'https://' + config['api_server'] + '/meta/v3/' + config['dbname'] + '/' + collection + '/_indexes/' + name
-    resp = requests.put(url, json=index, headers=headers)
+    resp = getSession(config).put(url, json=index, headers=headers)
     if resp.status_code != 200:
         print('Got unexpected status code: ' + str(resp.status_code))
     else:
@@ -78,7 +46,7 @@ def showIndexes(token, config, collection):
 
     # show collection info
     url = 'https://' + config['api_server'] + '/meta/v3/' + config['dbname'] + '/' + collection + '/_indexes'
-    resp = requests.get(url, headers=headers)
+    resp = getSession(config).get(url, headers=headers)
     print(json.dumps(resp.json(), indent=2))
 
 # main entry